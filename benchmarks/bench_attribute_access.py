@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+"""Load rows and read/write public attribute names through properties generated by
+add_public_properties, against a copy of the original __getattr__/__setattr__
+name-mangling. Both models are otherwise identical."""
+from sqlalchemy import Column, Unicode
+from sqlalchemy.ext.declarative import declarative_base
+
+from fixtures import new_session, timeit
+from node.model import UTCDateTime, datetime_utc_now, add_public_properties
+
+BenchBase = declarative_base()
+
+
+class NodeColumns(object):
+    uuid = Column(Unicode(36), primary_key=True)
+    discriminator = Column(Unicode(50))
+    _node_key = Column('node_key', Unicode(100))
+    _created_at = Column('created_at', UTCDateTime())
+    _modified_at = Column('modified_at', UTCDateTime())
+
+
+class MangledNode(NodeColumns, BenchBase):
+    __tablename__ = 'mangled_nodes'
+
+    def __getattr__(self, attr):
+        attr = '_{0}'.format(attr)
+        if attr in self.__class__.__dict__:
+            return object.__getattribute__(self, attr)
+        else:
+            raise AttributeError
+
+    def __setattr__(self, attr, value):
+        if attr in self.__class__.__dict__ or attr == '_sa_instance_state':
+            object.__setattr__(self, attr, value)
+        else:
+            object.__setattr__(self, '_{0}'.format(attr), value)
+
+
+class PropertyNode(NodeColumns, BenchBase):
+    __tablename__ = 'property_nodes'
+
+add_public_properties(PropertyNode)
+
+
+def fill(sess, count):
+    now = datetime_utc_now()
+    for cls in (MangledNode, PropertyNode):
+        rows = [{'uuid': u'{0:036d}'.format(i), 'discriminator': u'node', 'created_at': now, 'modified_at': now}
+                for i in xrange(count)]
+        sess.execute(cls.__table__.insert(), rows)
+    sess.commit()
+
+
+def load(sess, cls):
+    sess.expunge_all()
+    return sess.query(cls).all()
+
+
+def touch(nodes):
+    for node in nodes:
+        node.node_key = node.created_at and None
+        node.modified_at
+
+
+def main(count=100000):
+    sess = new_session()
+    BenchBase.metadata.create_all(sess.bind)
+    fill(sess, count)
+    print "{0} rows".format(count)
+    for name, cls in (('name-mangling', MangledNode), ('properties', PropertyNode)):
+        nodes = load(sess, cls)
+        print "{0:<20} load {1:10.2f} ms   read/write {2:10.2f} ms".format(
+            name, timeit(lambda: load(sess, cls), repeat=3) * 1000, timeit(lambda: touch(nodes), repeat=3) * 1000)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+"""Compare Edge.check_circular_reference (CTE / BFS) against the original
+recursive implementation, which issued one query per descendant."""
+from fixtures import new_session, build_tree, timeit, Node
+from node.model import Edge
+
+
+def check_circular_reference_recursive(parent, child):
+    if parent and parent == child:
+        raise Exception('Cirular reference')
+    if parent and child:
+        for grandchild in child._get_children():
+            check_circular_reference_recursive(parent, grandchild)
+
+
+def main(depth=6, fanout=4):
+    sess = new_session()
+    root, leaves = build_tree(sess, depth, fanout)
+    outsider = Node()
+    sess.add(outsider)
+    sess.commit()
+    print "Tree depth={0} fanout={1} nodes={2}".format(depth, fanout, sess.query(Node).count())
+
+    # worst case: attach root below a node that is not in the tree,
+    # the whole subtree under root has to be walked
+    results = [
+        ('recursive', timeit(lambda: check_circular_reference_recursive(outsider, root), repeat=1)),
+        ('bfs', timeit(lambda: Edge.is_reachable(sess, root.uuid, outsider.uuid, strategy='bfs'))),
+        ('cte', timeit(lambda: Edge.is_reachable(sess, root.uuid, outsider.uuid, strategy='cte'))),
+    ]
+    # early exit: leaf is found as soon as it is reached
+    results.append(('cte (cycle found)', timeit(lambda: Edge.is_reachable(sess, root.uuid, leaves[0].uuid, strategy='cte'))))
+    results.append(('bfs (cycle found)', timeit(lambda: Edge.is_reachable(sess, root.uuid, leaves[0].uuid, strategy='bfs'))))
+
+    for name, elapsed in results:
+        print "{0:<20} {1:10.2f} ms".format(name, elapsed * 1000)
+
+
+if __name__ == '__main__':
+    main()
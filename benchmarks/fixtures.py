@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+"""Shared in-memory SQLite fixtures for the benchmark scripts.
+
+Run the scripts from the repository root, e.g.:
+    python benchmarks/bench_cycle_check.py
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from node import Base
+from node.model import AbstractNode, Edge, Children, Parents
+
+
+class Node(AbstractNode):
+    __tablename__ = 'nodes'
+    __mapper_args__ = {'polymorphic_on': AbstractNode.discriminator, 'polymorphic_identity': u'node'}
+    children = Children()
+    parents = Parents()
+
+
+def new_session(db_url='sqlite://'):
+    engine = create_engine(db_url)
+    Base.metadata.create_all(engine)
+    return sessionmaker(bind=engine, autoflush=False)()
+
+
+def build_tree(sess, depth, fanout):
+    """Build a complete tree, returns (root, list of leaves)"""
+    root = Node()
+    sess.add(root)
+    level = [root]
+    for _ in xrange(depth):
+        next_level = []
+        for parent in level:
+            for i in xrange(fanout):
+                child = Node()
+                edge = Edge()
+                edge.parent = parent
+                edge.child = child
+                edge._index = i
+                sess.add(edge)
+                next_level.append(child)
+        level = next_level
+    sess.commit()
+    return root, level
+
+
+def timeit(func, repeat=5):
+    best = None
+    for _ in xrange(repeat):
+        start = time.time()
+        func()
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
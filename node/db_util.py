@@ -1,8 +1,16 @@
 # -*- coding: utf-8 -*-
-from sqlalchemy.orm import sessionmaker
+import bisect
+import itertools
+import threading
+import time
+
+from sqlalchemy.orm import sessionmaker, Session
 from sqlalchemy import create_engine, event
+from sqlalchemy.sql.expression import Select, CompoundSelect
 
 from node import Base
+from node.model import EdgeClosure, EdgeMetaIndex, NodeMetaIndex
+from node.util import get_json_engine_params
 
 # conf.yaml
 # db_url: mysql://root@localhost:3306/
@@ -12,31 +20,310 @@ from node import Base
 # engine_params:
 #     pool_recycle: 3600
 #     echo: False
+# optional read replicas, each overriding keys of the primary conf
+# replicas:
+#     - db_url: mysql://root@replica1:3306/
+#     - db_url: mysql://root@replica2:3306/
+# replica_strategy: round_robin  # or least_loaded
+# read_your_writes: 5  # seconds a session reads from the primary after commit
+
+# seconds, upper bounds of the checkout latency histogram buckets
+CHECKOUT_LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+
+
+class PoolMetrics(object):
+    """Counts pool events of one engine. Recycles are reconnects of a pooled
+    connection that was not invalidated, i.e. pool_recycle expiring it."""
+
+    def __init__(self, engine):
+        super(PoolMetrics, self).__init__()
+        self.engine = engine
+        self.connects = 0
+        self.checkouts = 0
+        self.checkins = 0
+        self.recycles = 0
+        self.invalidations = 0
+        self.latency_counts = [0] * (len(CHECKOUT_LATENCY_BUCKETS) + 1)
+        self.latency_total = 0.0
+        event.listen(engine, 'connect', self._on_connect)
+        event.listen(engine, 'checkout', self._on_checkout)
+        event.listen(engine, 'checkin', self._on_checkin)
+        event.listen(engine, 'invalidate', self._on_invalidate)
+        event.listen(engine, 'soft_invalidate', self._on_invalidate)
+        # dispose() replaces the pool, listeners are carried over, the timing wrapper is not
+        event.listen(engine, 'engine_disposed', lambda engine: self._wrap_pool_connect())
+        self._wrap_pool_connect()
+
+    def _wrap_pool_connect(self):
+        pool = self.engine.pool
+        connect = pool.connect
+
+        def timed_connect():
+            started_at = time.time()
+            connection = connect()
+            self._add_latency(time.time() - started_at)
+            return connection
+
+        # the engine looks up pool.connect on every checkout
+        pool.connect = timed_connect
+
+    def _add_latency(self, seconds):
+        self.latency_counts[bisect.bisect_left(CHECKOUT_LATENCY_BUCKETS, seconds)] += 1
+        self.latency_total += seconds
+
+    def _on_connect(self, dbapi_conn, conn_record):
+        self.connects += 1
+        record_info = conn_record.record_info
+        if record_info.pop('node.invalidated', False):
+            pass
+        elif record_info.get('node.connected'):
+            self.recycles += 1
+        record_info['node.connected'] = True
+
+    def _on_checkout(self, dbapi_conn, conn_record, conn_proxy):
+        self.checkouts += 1
+
+    def _on_checkin(self, dbapi_conn, conn_record):
+        self.checkins += 1
+
+    @property
+    def checked_out(self):
+        return self.checkouts - self.checkins
+
+    def _on_invalidate(self, dbapi_conn, conn_record, exception):
+        self.invalidations += 1
+        conn_record.record_info['node.invalidated'] = True
+
+    def get_latency_histogram(self):
+        """[(upper bound in seconds or None for the rest, count)]"""
+        return zip(CHECKOUT_LATENCY_BUCKETS + (None, ), self.latency_counts)
+
+    def as_dict(self):
+        pool = self.engine.pool
+        return {
+            'pool': pool.status(),
+            'size': pool.size() if hasattr(pool, 'size') else None,
+            'checked_out': pool.checkedout() if hasattr(pool, 'checkedout') else self.checked_out,
+            'overflow': pool.overflow() if hasattr(pool, 'overflow') else None,
+            'connects': self.connects,
+            'checkouts': self.checkouts,
+            'recycles': self.recycles,
+            'invalidations': self.invalidations,
+            'checkout_latency_total': self.latency_total,
+            'checkout_latency_histogram': self.get_latency_histogram()
+        }
+
+
+class EngineRegistry(object):
+    """Process wide engines, one per db url, charset, collate and engine_params.
+    DBUtil and NodeMiddleware built from the same conf share a pool."""
+
+    engines = {}
+    metrics = {}
+    lock = threading.Lock()
+
+    @classmethod
+    def get_engine(cls, conf):
+        conf = DBUtil.normalize_conf(conf)
+        key = cls.get_key(conf)
+        with cls.lock:
+            engine = cls.engines.get(key)
+            if engine is None:
+                engine = cls.engines[key] = cls.new_engine(conf)
+                cls.metrics[key] = PoolMetrics(engine)
+            return engine
+
+    @classmethod
+    def get_key(cls, conf):
+        conf = DBUtil.normalize_conf(conf)
+        # engine_params values may be unhashable
+        engine_params = tuple(sorted((key, repr(value)) for key, value in (conf.get('engine_params') or {}).iteritems()))
+        return (DBUtil.get_engine_url(conf), conf.get('db_charset'), conf.get('db_collate'), engine_params)
+
+    @classmethod
+    def new_engine(cls, conf):
+        engine_params = dict(get_json_engine_params(), **(conf.get('engine_params') or {}))
+        engine = create_engine(DBUtil.get_engine_url(conf), **engine_params)
+        if engine.dialect.name == 'mysql' and conf.get('db_charset'):
+            # SET NAMES sets character_set_client, _connection and _results in one statement
+            statement = "SET NAMES '{0}'".format(conf.get('db_charset'))
+            if conf.get('db_collate'):
+                statement += " COLLATE '{0}'".format(conf.get('db_collate'))
+
+            def on_engine_connect(dbapi_conn, conn_record):
+                cursor = dbapi_conn.cursor()
+                cursor.execute(statement)
+                cursor.close()
+
+            event.listen(engine, 'connect', on_engine_connect)
+        return engine
+
+    @classmethod
+    def get_pool_metrics(cls, engine):
+        """PoolMetrics of a registered engine"""
+        for key, registered in cls.engines.items():
+            if registered is engine:
+                return cls.metrics[key]
+        return None
+
+    @classmethod
+    def get_metrics(cls, conf=None):
+        """Pool metrics of the engine for conf, see PoolMetrics.as_dict. Without
+        conf, a list of (engine url, metrics) for every engine."""
+        if conf is not None:
+            metrics = cls.metrics.get(cls.get_key(conf))
+            return metrics.as_dict() if metrics else None
+        return [(key[0], metrics.as_dict()) for key, metrics in cls.metrics.items()]
+
+    @classmethod
+    def forget_all(cls):
+        """Drop engines without closing their connections, in forked processes
+        where the pooled connections belong to the parent"""
+        with cls.lock:
+            cls.engines.clear()
+            cls.metrics.clear()
+
+    @classmethod
+    def dispose_all(cls):
+        with cls.lock:
+            for engine in cls.engines.values():
+                engine.dispose()
+            cls.engines.clear()
+            cls.metrics.clear()
+
+
+class ReplicaSet(object):
+    """Read replica engines. strategy is 'round_robin' or 'least_loaded', the
+    replica with the fewest checked out connections."""
+
+    ROUND_ROBIN = 'round_robin'
+    LEAST_LOADED = 'least_loaded'
+
+    def __init__(self, engines, strategy=ROUND_ROBIN):
+        super(ReplicaSet, self).__init__()
+        assert engines
+        assert strategy in (self.ROUND_ROBIN, self.LEAST_LOADED)
+        self.engines = list(engines)
+        self.strategy = strategy
+        self._cycle = itertools.cycle(self.engines)
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, conf):
+        engines = []
+        for replica in conf.get('replicas'):
+            replica_conf = dict(conf, **replica)
+            del replica_conf['replicas']
+            engines.append(EngineRegistry.get_engine(replica_conf))
+        return cls(engines, conf.get('replica_strategy') or cls.ROUND_ROBIN)
+
+    def get_engine(self):
+        if self.strategy == self.LEAST_LOADED:
+            return min(self.engines, key=self._get_load)
+        with self._lock:
+            return next(self._cycle)
+
+    def _get_load(self, engine):
+        metrics = EngineRegistry.get_pool_metrics(engine)
+        return metrics.checked_out if metrics else 0
+
+
+class RoutingSession(Session):
+    """Sends plain SELECTs to a replica and everything else to the primary bind.
+
+    A transaction reads from one replica, picked when its first read runs. Once
+    the session flushes or executes a write, reads go to the primary until the
+    transaction ends, and for read_your_writes seconds after a commit. Set
+    use_primary to read from the primary regardless, mark_written() before
+    reads a write depends on."""
+
+    def __init__(self, replicas=None, read_your_writes=None, **kws):
+        super(RoutingSession, self).__init__(**kws)
+        self.replicas = replicas
+        self.read_your_writes = read_your_writes
+        self.use_primary = False
+        self._wrote = False
+        self._replica = None
+        self._primary_until = None
+        event.listen(self, 'after_flush', RoutingSession._after_flush)
+        event.listen(self, 'after_commit', RoutingSession._after_commit)
+        event.listen(self, 'after_transaction_end', RoutingSession._after_transaction_end)
+
+    def get_bind(self, mapper=None, clause=None):
+        if self.replicas is not None and not self._flushing and self._is_read(clause):
+            if not self.reads_on_primary:
+                if self._replica is None:
+                    self._replica = self.replicas.get_engine()
+                return self._replica
+        elif clause is not None:
+            self._wrote = True
+        return super(RoutingSession, self).get_bind(mapper=mapper, clause=clause)
+
+    def mark_written(self):
+        """Read from the primary until the transaction ends, as after a flush"""
+        self._wrote = True
+
+    @property
+    def reads_on_primary(self):
+        if self.use_primary or self._wrote:
+            return True
+        return self._primary_until is not None and time.time() < self._primary_until
+
+    @staticmethod
+    def _is_read(clause):
+        return isinstance(clause, (Select, CompoundSelect)) and clause._for_update_arg is None
+
+    @staticmethod
+    def _after_flush(session, flush_context):
+        session._wrote = True
+
+    @staticmethod
+    def _after_commit(session):
+        if session._wrote and session.read_your_writes:
+            session._primary_until = time.time() + session.read_your_writes
+
+    @staticmethod
+    def _after_transaction_end(session, transaction):
+        if transaction.parent is None:
+            session._wrote = False
+            session._replica = None
+
 
 class DBUtil(object):
 
     def __init__(self, conf, *args, **kw):
         assert 'db_url' in conf
         assert 'db_name' in conf
+        self.config = self.normalize_conf(conf)
+
+    @classmethod
+    def normalize_conf(cls, conf):
+        """conf with the default charset and collation filled in"""
         # defaults
-        self.config = {
+        config = {
             u'db_charset': u'utf8mb4',
             u'db_collate': u'utf8mb4_unicode_ci'
         }
-        self.config.update(conf)
+        config.update(conf)
+        return config
 
     def init_sessionmaker(self):
-        self.sessionmaker = sessionmaker(autoflush=False)
-        self.engine = create_engine(self.get_engine_url(self.config), **self.config.get('engine_params', {}))
-        self.sessionmaker.configure(bind=self.engine)
+        self.engine = EngineRegistry.get_engine(self.config)
+        self.sessionmaker = sessionmaker(autoflush=False, bind=self.engine, **self.get_routing_params(self.config))
 
-        def on_engine_connect(dbapi_conn, conn_record):
-            cursor = dbapi_conn.cursor()
-            cursor.execute("SET NAMES '{db_charset}' COLLATE '{db_collate}'".format(**self.config))
-            cursor.execute("SET CHARACTER SET {db_charset}".format(**self.config))
-            cursor.execute("SET character_set_connection={db_charset}".format(**self.config))
+    @classmethod
+    def get_routing_params(cls, conf, session_cls=RoutingSession):
+        """sessionmaker params routing reads to the configured replicas, empty without replicas"""
+        if not conf.get('replicas'):
+            return {}
+        return {
+            'class_': session_cls,
+            'replicas': ReplicaSet.from_config(conf),
+            'read_your_writes': conf.get('read_your_writes')
+        }
 
-        event.listen(self.engine, 'connect', on_engine_connect)
+    def get_pool_metrics(self):
+        return EngineRegistry.get_metrics(self.config)
 
     def recreate_db(self):
         assert 'db_url' in self.config
@@ -70,6 +357,30 @@ class DBUtil(object):
         sess.commit()
         print "Tables dropped"
 
+    def rebuild_closure(self, sess):
+        EdgeClosure.rebuild(sess)
+        sess.commit()
+        print "Edge closure rebuilt"
+
+    def check_closure(self, sess):
+        """Returns list of closure rows not matching the edges table, see EdgeClosure.check"""
+        mismatches = EdgeClosure.check(sess)
+        print "Edge closure {0}".format("consistent" if not mismatches else "has {0} mismatching rows".format(len(mismatches)))
+        return mismatches
+
+    def rebuild_meta_index(self, sess):
+        EdgeMetaIndex.rebuild(sess)
+        NodeMetaIndex.rebuild(sess)
+        sess.commit()
+        print "Meta index rebuilt"
+
+    def reindex(self, **kws):
+        """Rebuild the search index from the node table, see node.index.Reindexer"""
+        from node.index import Reindexer
+        stats = Reindexer(self.config, **kws).run()
+        print "Index rebuilt: {0}".format(stats)
+        return stats
+
     def new_session(self):
         return self.sessionmaker()
 
@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+"""Streaming subtree export to NDJSON, the format read by node.importer.
+
+All nodes of the subtree are written first, ordered by uuid, then the edges
+leaving them, ordered by left_uuid. Each pass is one query read through a
+server-side cursor (stream_results), so memory stays constant. Backends
+without recursive CTEs or the closure table fall back to collecting the
+subtree uuids in memory.
+
+A checkpoint callback receives (phase, uuid) once everything up to and
+including uuid is written, pass it back as resume=(phase, uuid) to continue.
+"""
+import datetime
+
+from sqlalchemy import and_, select, literal, union, Unicode
+
+from node.importer import ImportStats, NODE, EDGE
+from node.model import AbstractNode, Edge, EdgeClosure
+from node.util import get_json_codec
+
+
+class ExportStats(ImportStats):
+    pass
+
+
+class GraphExporter(object):
+    """with open('subtree.ndjson', 'wb') as out:
+        GraphExporter(session).export_subtree(root, out)
+
+    group/relation_type filter the traversed (and exported) edges, False for any."""
+
+    def __init__(self, session, chunk_size=1000, group=False, relation_type=False, max_depth=None, checkpoint=None):
+        super(GraphExporter, self).__init__()
+        self.session = session
+        self.chunk_size = chunk_size
+        self.group = group
+        self.relation_type = relation_type
+        self.max_depth = max_depth
+        self.checkpoint = checkpoint
+        self.node_cls = AbstractNode.get_node_cls()
+        self.node_table = self.node_cls.__table__
+        self.edge_table = Edge.__table__
+        self.codec = get_json_codec()
+        self.stats = ExportStats()
+
+    def export_subtree(self, root, out, resume=None):
+        """Write root, its descendants and the edges between them to out"""
+        phase, after_uuid = resume or (NODE, None)
+        subtree = self._get_subtree(root.uuid)
+        if phase == NODE:
+            self._export_nodes(subtree, out, after_uuid)
+            after_uuid = None
+        self._export_edges(subtree, out, after_uuid)
+        return self.stats
+
+    def _export_nodes(self, subtree, out, after_uuid=None):
+        nodes = self.node_table
+        for rows in self._iter_chunks(subtree, nodes, nodes.c.uuid, [nodes.c.uuid], after_uuid):
+            for row in rows:
+                self._write(out, NODE, row, nodes)
+            self.stats.nodes += len(rows)
+            if self.checkpoint:
+                self.checkpoint(NODE, rows[-1]['uuid'])
+
+    def _export_edges(self, subtree, out, after_uuid=None):
+        edges = self.edge_table
+        clauses = Edge._get_edge_filter_clauses(self.group, self.relation_type)
+        inside = None
+        if self.max_depth is not None:
+            # edges below the deepest level lead out of the export
+            if isinstance(subtree, list):
+                inside = set(subtree)
+            else:
+                clauses.append(edges.c.right_uuid.in_(select([subtree.c.uuid])))
+        pending_uuid = None
+        for rows in self._iter_chunks(subtree, edges, edges.c.left_uuid, [edges.c.left_uuid, edges.c.id], after_uuid, clauses):
+            if inside is not None:
+                rows = [row for row in rows if row['right_uuid'] in inside]
+            for row in rows:
+                if self.checkpoint and pending_uuid is not None and row['left_uuid'] != pending_uuid:
+                    # all edges of the previous node are written
+                    self.checkpoint(EDGE, pending_uuid)
+                pending_uuid = row['left_uuid']
+                self._write(out, EDGE, row, edges, exclude=('id', ))
+            self.stats.edges += len(rows)
+        if self.checkpoint and pending_uuid is not None:
+            self.checkpoint(EDGE, pending_uuid)
+
+    def _iter_chunks(self, subtree, table, uuid_column, order_by, after_uuid=None, clauses=None):
+        """Yield lists of rows of table where uuid_column is in the subtree"""
+        clauses = list(clauses or [])
+        if after_uuid is not None:
+            clauses.append(uuid_column > after_uuid)
+        if isinstance(subtree, list):
+            # no recursive CTE, uuids collected in memory
+            uuids = [uuid_string for uuid_string in subtree if after_uuid is None or uuid_string > after_uuid]
+            for i in xrange(0, len(uuids), self.chunk_size):
+                chunk_clauses = clauses + [uuid_column.in_(uuids[i:i + self.chunk_size])]
+                query = select([table]).where(and_(*chunk_clauses)).order_by(*order_by)
+                rows = self.session.execute(query, mapper=Edge).fetchall()
+                if rows:
+                    yield rows
+            return
+        query = select([table]).select_from(table.join(subtree, uuid_column == subtree.c.uuid))
+        if clauses:
+            query = query.where(and_(*clauses))
+        query = query.order_by(*order_by).execution_options(stream_results=True)
+        result = self.session.execute(query, mapper=Edge)
+        try:
+            while True:
+                rows = result.fetchmany(self.chunk_size)
+                if not rows:
+                    break
+                yield rows
+        finally:
+            result.close()
+
+    def _get_subtree(self, root_uuid):
+        """Selectable of distinct subtree uuids (root included), or a sorted list"""
+        root = select([literal(root_uuid, Unicode).label('uuid')])
+        if Edge.use_closure_table and self.group is False and self.relation_type is False:
+            descendants = EdgeClosure.get_depths_select(root_uuid, Edge.CHILD, self.max_depth)
+            descendants = select([descendants.alias('descendants').c.uuid])
+        elif Edge.supports_recursive_cte(self.session):
+            traversal = Edge.get_traversal_cte(root_uuid, Edge.CHILD, self.group, self.relation_type, self.max_depth)
+            descendants = select([traversal.c.uuid])
+        else:
+            uuids = set([root_uuid])
+            for level in Edge.walk(self.session, root_uuid, Edge.CHILD, self.group, self.relation_type, self.max_depth):
+                uuids.update(uuid_string for uuid_string, depth in level)
+            return sorted(uuids)
+        # union drops duplicates
+        return union(root, descendants).alias('subtree')
+
+    def _write(self, out, record_type, row, table, exclude=()):
+        record = {'type': record_type}
+        for column in table.c:
+            if column.name not in exclude:
+                record[column.name] = to_json_value(row[column.name])
+        out.write((self.codec.dumps(record) + u'\n').encode('utf-8'))
+
+
+def to_json_value(value):
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    return value
@@ -0,0 +1,253 @@
+# -*- coding: utf-8 -*-
+"""Bulk graph import through SQLAlchemy Core, bypassing the ORM.
+
+Records are dicts keyed by table column name. NDJSON lines carry a "type" of
+"node" or "edge", CSV has one file for nodes and one for edges:
+
+{"type": "node", "uuid": "...", "discriminator": "article", "created_at": "2016-01-01T00:00:00+00:00"}
+{"type": "edge", "left_uuid": "...", "right_uuid": "...", "group_name": null, "index": 0, "meta_data": {"role": "owner"}}
+
+Nodes are inserted into the node class table, so subclasses must share it
+(single table inheritance). Nothing is committed, commit the session when
+import_ndjson/import_csv returns.
+"""
+import csv
+import re
+import time
+import uuid
+from collections import defaultdict, deque
+
+try:
+    # python-dateutil >= 2.7, much faster for ISO 8601
+    from dateutil.parser import isoparse as parse_datetime
+except ImportError:
+    from dateutil.parser import parse as parse_datetime
+from dateutil.tz import tzutc
+from sqlalchemy import Integer
+
+from node.model import AbstractNode, Edge, EdgeClosure, EdgeMetaIndex, NodeMetaIndex, UTCDateTime, datetime_utc_now, get_indexed_dict_properties
+from node.util import JSONEncodedObj, get_json_codec, get_subclasses
+
+UUID4_RE = re.compile(r'^[0-9a-f]{8}-[0-9a-f]{4}-4[0-9a-f]{3}-[89ab][0-9a-f]{3}-[0-9a-f]{12}$')
+
+NODE = u'node'
+EDGE = u'edge'
+
+
+class ImportStats(object):
+
+    def __init__(self):
+        super(ImportStats, self).__init__()
+        self.nodes = 0
+        self.edges = 0
+        self.started_at = time.time()
+
+    @property
+    def elapsed(self):
+        return time.time() - self.started_at
+
+    @property
+    def rate(self):
+        """records per second"""
+        elapsed = self.elapsed
+        return (self.nodes + self.edges) / elapsed if elapsed > 0 else 0.0
+
+    def __str__(self):
+        return '{0} nodes, {1} edges in {2:.1f}s ({3:.0f} records/s)'.format(self.nodes, self.edges, self.elapsed, self.rate)
+
+
+class GraphImporter(object):
+    """importer = GraphImporter(session, progress=lambda stats: log.info(stats))
+    importer.import_ndjson(open('graph.ndjson'))
+    session.commit()
+
+    check_cycles: after loading, look for cycles among the imported edges.
+    Cycles through edges that existed before the import are not detected.
+    rebuild_derived: rebuild the closure and meta index tables when enabled,
+    the bulk inserts bypass their flush hooks."""
+
+    def __init__(self, session, batch_size=5000, check_cycles=True, rebuild_derived=True, progress=None, progress_every=100000):
+        super(GraphImporter, self).__init__()
+        self.session = session
+        self.batch_size = batch_size
+        self.check_cycles = check_cycles
+        self.rebuild_derived = rebuild_derived
+        self.progress = progress
+        self.progress_every = progress_every
+        self.node_cls = AbstractNode.get_node_cls()
+        self.node_table = self.node_cls.__table__
+        self.edge_table = Edge.__table__
+        # executemany needs the same keys in every row
+        self._defaults = {
+            self.node_table: get_column_defaults(self.node_table),
+            self.edge_table: get_column_defaults(self.edge_table, exclude=('id', ))
+        }
+        self.stats = ImportStats()
+        self._nodes = []
+        self._edges = []
+        self._pairs = []
+        self._reported = 0
+
+    def import_ndjson(self, lines):
+        codec = get_json_codec()
+        for line in lines:
+            line = line.strip()
+            if not line:
+                continue
+            record = codec.loads(line)
+            record_type = record.pop('type', None)
+            if record_type == NODE:
+                self.add_node(record)
+            elif record_type == EDGE:
+                self.add_edge(record)
+            else:
+                raise ValueError(u'Unknown record type "{0}"'.format(record_type))
+        return self.finish()
+
+    def import_csv(self, nodes_file=None, edges_file=None):
+        """CSV files with a header row of column names, empty values are NULL"""
+        for csv_file, add in ((nodes_file, self.add_node), (edges_file, self.add_edge)):
+            if csv_file is None:
+                continue
+            for row in csv.DictReader(csv_file):
+                add(dict((key, value.decode('utf-8') if value else None) for key, value in row.iteritems()), from_text=True)
+        return self.finish()
+
+    def add_node(self, record, from_text=False):
+        row = self._get_row(self.node_table, record, from_text)
+        if row.get('uuid') is None:
+            row['uuid'] = unicode(uuid.uuid4())
+        if row.get('discriminator') is None:
+            row['discriminator'] = self.node_cls.get_polymorphic_identity()
+        self._nodes.append(row)
+        self.stats.nodes += 1
+        if len(self._nodes) >= self.batch_size:
+            self._flush_nodes()
+        self._report()
+
+    def add_edge(self, record, from_text=False):
+        if 'id' in record:
+            record = dict(record)
+            del record['id']
+        row = self._get_row(self.edge_table, record, from_text)
+        if row.get('left_uuid') is None or row.get('right_uuid') is None:
+            raise ValueError(u'Edge record without left_uuid/right_uuid: {0}'.format(record))
+        self._edges.append(row)
+        self._pairs.append((row['left_uuid'], row['right_uuid']))
+        self.stats.edges += 1
+        if len(self._edges) >= self.batch_size:
+            self._flush_edges()
+        self._report()
+
+    def finish(self):
+        self._flush_edges()
+        if self.check_cycles:
+            cycle_uuid = find_cycle(self._pairs)
+            if cycle_uuid is not None:
+                raise Exception(u'Cirular reference through {0}'.format(cycle_uuid))
+        if self.rebuild_derived:
+            if Edge.use_closure_table:
+                EdgeClosure.rebuild(self.session)
+            if Edge.indexed_meta_keys:
+                EdgeMetaIndex.rebuild(self.session)
+            if any(get_indexed_dict_properties(cls) for cls in [self.node_cls] + get_subclasses(self.node_cls)):
+                NodeMetaIndex.rebuild(self.session)
+        self._pairs = []
+        if self.progress:
+            self.progress(self.stats)
+        return self.stats
+
+    def _flush_nodes(self):
+        if self._nodes:
+            validate_uuids([row['uuid'] for row in self._nodes])
+            self.session.execute(self.node_table.insert(), self._nodes, mapper=self.node_cls)
+            self._nodes = []
+
+    def _flush_edges(self):
+        # edges may reference nodes of the current batch
+        self._flush_nodes()
+        if self._edges:
+            validate_uuids([uuid_string for row in self._edges for uuid_string in (row['left_uuid'], row['right_uuid'])])
+            self.session.execute(self.edge_table.insert(), self._edges, mapper=Edge)
+            self._edges = []
+
+    def _report(self):
+        if self.progress and self.stats.nodes + self.stats.edges - self._reported >= self.progress_every:
+            self._reported = self.stats.nodes + self.stats.edges
+            self.progress(self.stats)
+
+    def _get_row(self, table, record, from_text):
+        now = None
+        row = dict(self._defaults[table])
+        for key, value in record.iteritems():
+            if key not in table.c:
+                raise ValueError(u'Unknown column "{0}" in {1}'.format(key, table.name))
+            row[key] = coerce_value(table.c[key].type, value, from_text)
+        for key in ('created_at', 'modified_at'):
+            if key in table.c and row.get(key) is None:
+                now = now or datetime_utc_now()
+                row[key] = now
+        return row
+
+
+def coerce_value(column_type, value, from_text=False):
+    """Convert a decoded NDJSON (or CSV text) value to what the column type binds"""
+    if value is None:
+        return None
+    if isinstance(value, str):
+        value = value.decode('utf-8')
+    if isinstance(column_type, UTCDateTime):
+        if isinstance(value, basestring):
+            value = parse_datetime(value)
+        if value.tzinfo is None:
+            value = value.replace(tzinfo=tzutc())
+        return value
+    if isinstance(column_type, Integer):
+        return int(value)
+    if isinstance(column_type, JSONEncodedObj) and from_text:
+        return get_json_codec().loads(value)
+    return value
+
+
+def get_column_defaults(table, exclude=()):
+    """{column name: scalar default or None}"""
+    defaults = {}
+    for column in table.c:
+        if column.name in exclude:
+            continue
+        default = column.default
+        defaults[column.name] = default.arg if default is not None and default.is_scalar else None
+    return defaults
+
+
+def validate_uuids(uuids):
+    """Raise on the first string that is not a lowercase uuid4, like validate_uuid4"""
+    match = UUID4_RE.match
+    for uuid_string in uuids:
+        if not match(uuid_string):
+            raise Exception(u'Invalid uuid {0}'.format(uuid_string))
+
+
+def find_cycle(pairs):
+    """Kahn's algorithm over (left_uuid, right_uuid) pairs. Returns a uuid on or
+    below a cycle, None for an acyclic graph."""
+    children = defaultdict(list)
+    indegree = defaultdict(int)
+    for left_uuid, right_uuid in pairs:
+        children[left_uuid].append(right_uuid)
+        indegree[right_uuid] += 1
+        indegree[left_uuid] += 0
+    queue = deque(uuid_string for uuid_string, degree in indegree.iteritems() if degree == 0)
+    remaining = len(indegree)
+    while queue:
+        uuid_string = queue.popleft()
+        remaining -= 1
+        for child_uuid in children.get(uuid_string, ()):
+            indegree[child_uuid] -= 1
+            if indegree[child_uuid] == 0:
+                queue.append(child_uuid)
+    if remaining == 0:
+        return None
+    for uuid_string, degree in indegree.iteritems():
+        if degree > 0:
+            return uuid_string
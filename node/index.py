@@ -1,17 +1,33 @@
 # -*- coding: utf-8 -*-
 import os
+import atexit
 import inspect
+import multiprocessing
+import zlib
+import threading
+import time
+import weakref
 import whoosh
 
+from collections import OrderedDict
+from contextlib import contextmanager
+from math import ceil
+from multiprocessing.pool import ThreadPool
+
 import whoosh.index as index
 import whoosh.fields as fields
 
 from whoosh.index import EmptyIndexError
-from whoosh.query import And, Or, Term, Prefix, FuzzyTerm, Not
+from whoosh.query import Term, Prefix, FuzzyTerm
 from whoosh.filedb.filestore import FileStorage
-from whoosh.writing import AsyncWriter
+from whoosh.writing import AsyncWriter, CLEAR, MERGE_SMALL, NO_MERGE, OPTIMIZE
 from whoosh.qparser import MultifieldParser, QueryParser #, WildcardPlugin, PrefixPlugin
 from whoosh.analysis import SimpleAnalyzer
+from sqlalchemy import event, select
+from sqlalchemy.orm import Session, sessionmaker
+
+from node.db_util import DBUtil, EngineRegistry
+from node.model import AbstractNode
 
 # To use index.py, required: Whoosh>=2.4.0
 
@@ -39,6 +55,500 @@ def get_index(name, schema, path, clean=False):
         return storage.open_index(indexname=name)
     except EmptyIndexError:
         return storage.create_index(schema, indexname=name)  
+
+
+class SearcherPool(object):
+    """Reusable searchers of one open index. acquire() hands out an idle
+    searcher, refreshed if the index generation changed since it was used."""
+
+    max_idle = 8
+
+    def __init__(self, ix):
+        super(SearcherPool, self).__init__()
+        self.ix = ix
+        self.idle = []
+        self.lent = {}
+        self.closed = False
+        # reentrant, weakref callbacks may run during gc while it is held
+        self.lock = threading.RLock()
+
+    def acquire(self):
+        with self.lock:
+            searcher = self.idle.pop() if self.idle else None
+        if searcher is None:
+            return self.ix.searcher()
+        # reuses the segment readers that did not change
+        return searcher.refresh()
+
+    def release(self, searcher):
+        with self.lock:
+            if not self.closed and len(self.idle) < self.max_idle:
+                self.idle.append(searcher)
+                return
+        searcher.close()
+
+    def lend(self, searcher, results):
+        """Release searcher once results is garbage collected, Results read
+        stored fields through their searcher."""
+        def on_collected(ref):
+            with self.lock:
+                self.lent.pop(ref, None)
+            self.release(searcher)
+        with self.lock:
+            self.lent[weakref.ref(results, on_collected)] = searcher
+
+    def close(self):
+        """Close idle searchers, lent ones are closed when released"""
+        with self.lock:
+            self.closed = True
+            idle, self.idle = self.idle, []
+        for searcher in idle:
+            searcher.close()
+
+
+# merge policies for BatchWriter, or pass a whoosh mergetype function
+MERGE_POLICIES = {
+    'small': MERGE_SMALL,
+    'none': NO_MERGE,
+    'optimize': OPTIMIZE
+}
+
+
+class BatchWriterStats(object):
+
+    def __init__(self):
+        super(BatchWriterStats, self).__init__()
+        self.commits = 0
+        self.operations = 0
+        self.max_batch_size = 0
+        self.last_batch_size = 0
+        self.commit_time = 0.0
+        self.max_commit_time = 0.0
+        self.errors = 0
+        self.last_error = None
+        # operations the writer raised on, dropped
+        self.rejected = 0
+
+    def add_commit(self, batch_size, seconds):
+        self.commits += 1
+        self.operations += batch_size
+        self.last_batch_size = batch_size
+        self.max_batch_size = max(self.max_batch_size, batch_size)
+        self.commit_time += seconds
+        self.max_commit_time = max(self.max_commit_time, seconds)
+
+    def as_dict(self):
+        return {
+            'commits': self.commits,
+            'operations': self.operations,
+            'mean_batch_size': float(self.operations) / self.commits if self.commits else 0.0,
+            'max_batch_size': self.max_batch_size,
+            'last_batch_size': self.last_batch_size,
+            'commit_time': self.commit_time,
+            'mean_commit_time': self.commit_time / self.commits if self.commits else 0.0,
+            'max_commit_time': self.max_commit_time,
+            'errors': self.errors,
+            'last_error': self.last_error,
+            'rejected': self.rejected
+        }
+
+
+class BatchWriter(object):
+    """Buffers adds, upserts and deletes and commits them as one segment from a
+    background thread, once batch_size operations are buffered or every
+    interval seconds. flush() commits the buffer from the calling thread.
+
+    merge_policy is a key of MERGE_POLICIES or a whoosh mergetype function.
+    Unknown fields raise UnknownFieldError when the operation is buffered. An
+    operation the writer still raises on is dropped and passed to on_error,
+    the others of its batch are committed. A failed commit puts its operations
+    back in front of the buffer."""
+
+    batch_size = 500
+    interval = 1.0
+    merge_policy = 'small'
+    lock_timeout = 10.0
+
+    def __init__(self, ix, batch_size=None, interval=None, merge_policy=None, on_error=None):
+        super(BatchWriter, self).__init__()
+        self.ix = ix
+        if batch_size is not None:
+            self.batch_size = batch_size
+        if interval is not None:
+            self.interval = interval
+        merge_policy = merge_policy or self.merge_policy
+        self.mergetype = MERGE_POLICIES[merge_policy] if isinstance(merge_policy, basestring) else merge_policy
+        self.on_error = on_error
+        self.stats = BatchWriterStats()
+        self.buffer = []
+        self.closed = False
+        self._lock = threading.Lock()
+        # one commit at a time, flush() may run next to the thread
+        self._commit_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+
+    def add_document(self, **fields):
+        self._append(('add_document', (), fields))
+
+    def update_document(self, **fields):
+        self._append(('update_document', (), fields))
+
+    def delete_by_term(self, fieldname, text):
+        self._append(('delete_by_term', (fieldname, text), {}))
+
+    def _append(self, operation):
+        if self.closed:
+            raise Exception('BatchWriter is closed')
+        method, args, kws = operation
+        schema = self.ix.schema
+        # whoosh would only raise at commit, from the thread
+        for name in (args[:1] if method == 'delete_by_term' else kws):
+            if not name.startswith('_') and name not in schema:
+                raise whoosh.fields.UnknownFieldError('No field named {0!r} in {1}'.format(name, schema))
+        with self._lock:
+            self.buffer.append(operation)
+            full = len(self.buffer) >= self.batch_size
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='node.index.BatchWriter')
+                self._thread.daemon = True
+                self._thread.start()
+        if full:
+            self._wakeup.set()
+
+    def _run(self):
+        while not self.closed:
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                self._report(e)
+
+    def flush(self):
+        """Commit buffered operations now, returns the number committed"""
+        with self._commit_lock:
+            with self._lock:
+                operations, self.buffer = self.buffer, []
+            if not operations:
+                return 0
+            started_at = time.time()
+            runs = self._split_runs(operations)
+            for i, run in enumerate(runs):
+                try:
+                    self._commit_run(run)
+                except Exception:
+                    with self._lock:
+                        self.buffer[:0] = [operation for run in runs[i:] for operation in run]
+                    raise
+            committed = sum(len(run) for run in runs)
+            self.stats.add_commit(committed, time.time() - started_at)
+            return committed
+
+    def _commit_run(self, run):
+        """Commit the operations of run with one writer. An operation raising is
+        removed from run and reported, the writer is cancelled and the rest retried."""
+        while run:
+            writer = self.ix.writer(timeout=self.lock_timeout)
+            for i, (method, args, kws) in enumerate(run):
+                try:
+                    getattr(writer, method)(*args, **kws)
+                except Exception as e:
+                    writer.cancel()
+                    del run[i]
+                    self._report(e, rejected=True)
+                    break
+            else:
+                writer.commit(mergetype=self.mergetype)
+                return
+
+    def _report(self, e, rejected=False):
+        self.stats.errors += 1
+        self.stats.last_error = repr(e)
+        if rejected:
+            self.stats.rejected += 1
+        if self.on_error:
+            self.on_error(e)
+
+    def _split_runs(self, operations):
+        """A whoosh writer does not delete documents added through itself, start
+        a new writer when a delete, or the delete of update_document, could
+        match a document added in the current one."""
+        unique_fields = [name for name, field in self.ix.schema.items() if field.unique]
+        runs = [[]]
+        added = set()
+        for operation in operations:
+            method, args, kws = operation
+            if method == 'delete_by_term':
+                terms = [args] if args[0] in unique_fields else None
+            else:
+                terms = [(name, kws[name]) for name in unique_fields if name in kws]
+            if added and method != 'add_document' and (terms is None or added.intersection(terms)):
+                runs.append([])
+                added = set()
+            runs[-1].append(operation)
+            if method != 'delete_by_term':
+                added.update(terms)
+        return runs
+
+    def close(self):
+        """Stop the thread and commit what is left"""
+        self.closed = True
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush()
+
+
+class LRUCache(object):
+
+    def __init__(self, max_size=1024):
+        super(LRUCache, self).__init__()
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                value = self.entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            # most recently used last
+            self.entries[key] = value
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = value
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def get_stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'size': len(self.entries)
+        }
+
+
+class ResultCache(LRUCache):
+    """Search results by key and index generation, an entry of an older
+    generation is dropped on lookup (counted as invalidation and miss)."""
+
+    def __init__(self, max_size=1024):
+        super(ResultCache, self).__init__(max_size)
+        self.invalidations = 0
+
+    def get(self, key, generation):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None or entry[0] != generation:
+                if entry is not None:
+                    self.invalidations += 1
+                self.misses += 1
+                return None
+            self.entries[key] = entry
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, generation, results):
+        super(ResultCache, self).set(key, (generation, results))
+
+    def get_stats(self):
+        return dict(super(ResultCache, self).get_stats(), invalidations=self.invalidations)
+
+
+class CachedHit(dict):
+    """Stored fields of a hit, with the Hit attributes that need no searcher"""
+
+    def __init__(self, fields, score, rank, docnum, shard=None):
+        super(CachedHit, self).__init__(fields)
+        self.score = score
+        self.rank = rank
+        # docnums are per shard in a ShardedIndex
+        self.docnum = docnum
+        self.shard = shard
+
+    def fields(self):
+        return dict(self)
+
+
+class CachedResults(object):
+    """Searcher free copy of whoosh Results"""
+
+    def __init__(self, hits, total, runtime=0.0):
+        super(CachedResults, self).__init__()
+        self.hits = hits
+        self.total = total
+        self.runtime = runtime
+
+    @classmethod
+    def from_results(cls, results, shard=None):
+        return cls(get_cached_hits(results, shard), len(results), results.runtime)
+
+    def __len__(self):
+        return self.total
+
+    def __getitem__(self, n):
+        return self.hits[n]
+
+    def __iter__(self):
+        return iter(self.hits)
+
+    def __nonzero__(self):
+        return bool(self.hits)
+
+    def is_empty(self):
+        return not self.hits
+
+    def scored_length(self):
+        return len(self.hits)
+
+    def fields(self, n):
+        return self.hits[n].fields()
+
+    def score(self, n):
+        return self.hits[n].score
+
+    def docnum(self, n):
+        return self.hits[n].docnum
+
+
+class CachedResultsPage(object):
+    """Searcher free copy of whoosh ResultsPage"""
+
+    def __init__(self, hits, total, pagecount, pagenum, offset, pagelen):
+        super(CachedResultsPage, self).__init__()
+        self.hits = hits
+        self.total = total
+        self.pagecount = pagecount
+        self.pagenum = pagenum
+        self.offset = offset
+        self.pagelen = pagelen
+
+    @classmethod
+    def from_page(cls, page):
+        return cls(get_cached_hits(page), page.total, page.pagecount, page.pagenum, page.offset, page.pagelen)
+
+    @classmethod
+    def from_top_hits(cls, hits, total, pagenum, pagelen):
+        """Page of hits ranked from the top, numbered like whoosh ResultsPage"""
+        if pagenum < 1:
+            raise ValueError("pagenum must be >= 1")
+        pagecount = int(ceil(total / float(pagelen)))
+        pagenum = min(pagecount, pagenum)
+        offset = (pagenum - 1) * pagelen
+        if (offset + pagelen) > total:
+            pagelen = total - offset
+        return cls(hits[max(offset, 0):offset + pagelen], total, pagecount, pagenum, offset, pagelen)
+
+    def __getitem__(self, n):
+        return self.hits[n]
+
+    def __iter__(self):
+        return iter(self.hits)
+
+    def __len__(self):
+        return len(self.hits)
+
+    def scored_length(self):
+        return len(self.hits)
+
+    def score(self, n):
+        return self.hits[n].score
+
+    def docnum(self, n):
+        return self.hits[n].docnum
+
+    def is_last_page(self):
+        return self.pagecount == 0 or self.pagenum == self.pagecount
+
+
+# parsed queries, see Index.build_query
+query_cache = LRUCache()
+# see Index.use_result_cache
+result_cache = ResultCache()
+# docnums of a discriminator by (index, reader generation, discriminator)
+discriminator_cache = LRUCache(256)
+
+def get_index_key(ix):
+    """Identifies an index in cache keys. A clean index starts over at
+    generation 0, the epoch tells it from the one it replaced."""
+    key = (os.path.abspath(ix.storage.folder) if hasattr(ix.storage, 'folder') else id(ix.storage), ix.indexname)
+    return key + (_index_epochs.get(key, 0), )
+
+def get_cached_hits(results, shard=None):
+    return [CachedHit(hit.fields(), hit.score, hit.rank, hit.docnum, shard) for hit in results]
+
+
+
+# open indexes and their searcher pools by (abspath, indexname)
+_index_cache = {}
+_index_cache_lock = threading.Lock()
+# BatchWriters of cached indexes, same keys
+_batch_writers = {}
+# ShardedIndex by (indexname, shards, shard_by)
+_sharded_indexes = {}
+# times an index was cleaned, see get_index_key
+_index_epochs = {}
+
+def get_cached_index(name, schema, path, clean=False):
+    """Returns (index, SearcherPool), opening the index once per process"""
+    key = (os.path.abspath(path), name)
+    with _index_cache_lock:
+        cached = _index_cache.get(key)
+        if cached is None or clean:
+            if cached is not None:
+                cached[1].close()
+                if key in _batch_writers:
+                    _batch_writers.pop(key).close()
+            if clean:
+                _index_epochs[key] = _index_epochs.get(key, 0) + 1
+            ix = get_index(name, schema, path, clean=clean)
+            cached = _index_cache[key] = (ix, SearcherPool(ix))
+        return cached
+
+def get_batch_writer(name, schema, path, **kws):
+    """BatchWriter of the cached index, kws are used when it is created"""
+    key = (os.path.abspath(path), name)
+    ix = get_cached_index(name, schema, path)[0]
+    with _index_cache_lock:
+        batch_writer = _batch_writers.get(key)
+        if batch_writer is None or batch_writer.closed:
+            batch_writer = _batch_writers[key] = BatchWriter(ix, **kws)
+        return batch_writer
+
+def close_cached_indexes():
+    with _index_cache_lock:
+        sharded_indexes = _sharded_indexes.values()
+        _sharded_indexes.clear()
+        batch_writers = _batch_writers.values()
+        _batch_writers.clear()
+        cached = _index_cache.values()
+        _index_cache.clear()
+    for sharded_index in sharded_indexes:
+        sharded_index.close()
+    for batch_writer in batch_writers:
+        batch_writer.close()
+    for ix, pool in cached:
+        pool.close()
+        ix.close()
+
+atexit.register(close_cached_indexes)
     
 analyzer = SimpleAnalyzer()
 search_default_schema = fields.Schema(
@@ -55,9 +565,24 @@ def get_default_path():
 
  
 class Index(object):
+
+    # add/upsert/delete go through the shared BatchWriter of the index
+    use_batch_writer = False
+    # search/search_page return CachedResults(Page) from result_cache
+    use_result_cache = False
+    # {'shards': 4, 'shard_by': 'uuid' or 'discriminator'}, see ShardedIndex
+    sharding = None
     
     @staticmethod
     def get_index(indexname=None, schema=None, path=None, clean=False):
+        return Index.get_cached(indexname=indexname, schema=schema, path=path, clean=clean)[0]
+
+    @staticmethod
+    def get_searcher_pool(indexname=None, schema=None, path=None):
+        return Index.get_cached(indexname=indexname, schema=schema, path=path)[1]
+
+    @staticmethod
+    def get_cached(indexname=None, schema=None, path=None, clean=False):
         if not indexname:
             indexname=u'default'
             
@@ -67,36 +592,98 @@ class Index(object):
         if not path:
             path = get_default_path()
             
-        return get_index(indexname, schema, path, clean=clean)
+        return get_cached_index(indexname, schema, path, clean=clean)
+
+    @staticmethod
+    @contextmanager
+    def searcher(indexname=None, schema=None):
+        """with Index.searcher() as searcher: ... returns it to the pool"""
+        pool = Index.get_searcher_pool(indexname=indexname, schema=schema)
+        searcher = pool.acquire()
+        try:
+            yield searcher
+        finally:
+            pool.release(searcher)
+
+    @staticmethod
+    def get_sharded(indexname=None, schema=None):
+        """ShardedIndex for Index.sharding"""
+        sharding = Index.sharding
+        key = (indexname or u'default', sharding.get('shards', 4), sharding.get('shard_by', ShardedIndex.UUID))
+        with _index_cache_lock:
+            sharded_index = _sharded_indexes.get(key)
+            if sharded_index is None:
+                sharded_index = _sharded_indexes[key] = ShardedIndex(key[0], key[1], key[2], schema=schema)
+            return sharded_index
+
+    @staticmethod
+    def close_all():
+        """Close cached indexes and pooled searchers, also run at exit"""
+        close_cached_indexes()
         
     @staticmethod
     def get_writer(indexname=None, schema=None):
+        if Index.use_batch_writer:
+            return Index.get_batch_writer(indexname=indexname, schema=schema)
         return AsyncWriter(Index.get_index(indexname=indexname, schema=schema))
 
+    @staticmethod
+    def get_batch_writer(indexname=None, schema=None, path=None, **kws):
+        """Shared BatchWriter, see BatchWriter for kws"""
+        return get_batch_writer(indexname or u'default', schema or search_default_schema, path or get_default_path(), **kws)
+
+    @staticmethod
+    def flush(indexname=None, schema=None):
+        """Commit buffered batch writes of the index"""
+        return Index.get_batch_writer(indexname=indexname, schema=schema).flush()
+
     @staticmethod
     def add(dict, indexname=None, schema=None):
+        if Index.sharding:
+            return Index.get_sharded(indexname, schema).write('add_document', **to_unicode(dict))
         writer = Index.get_writer(indexname=indexname, schema=schema)
         writer.add_document(**to_unicode(dict))
-        writer.commit()
+        Index._commit(writer)
         
     @staticmethod    
     def upsert(dict, indexname=None, schema=None):
+        if Index.sharding:
+            return Index.get_sharded(indexname, schema).write('update_document', **to_unicode(dict))
         writer = Index.get_writer(indexname=indexname, schema=schema)
         writer.update_document(**to_unicode(dict))
-        writer.commit()
+        Index._commit(writer)
 
     @staticmethod    
     def delete(id, indexname=None, schema=None):
+        if Index.sharding:
+            return Index.get_sharded(indexname, schema).write('delete_by_term', 'id', unicode(id))
         writer = Index.get_writer(indexname=indexname, schema=schema)
         writer.delete_by_term('id', unicode(id))
-        writer.commit()
+        Index._commit(writer)
+
+    @staticmethod
+    def _commit(writer):
+        # a BatchWriter commits in the background
+        if not isinstance(writer, BatchWriter):
+            writer.commit()
     
     @staticmethod
     def clean(indexname=None, schema=None):
+        if Index.sharding:
+            return Index.get_sharded(indexname, schema).clean()
         Index.get_index(indexname=indexname, clean=True, schema=schema)
                 
     @staticmethod
     def build_query(index, query, indexname=None, fields=None):
+        key = get_index_key(index) + (tuple(fields) if fields else None, query)
+        q = query_cache.get(key)
+        if q is None:
+            q = Index._parse_query(index, query, fields)
+            query_cache.set(key, q)
+        return q
+
+    @staticmethod
+    def _parse_query(index, query, fields=None):
         schema = index.schema
         if not fields:
             # query all fields (filter out any STORED types. These are not searchable)
@@ -109,20 +696,506 @@ class Index(object):
         return qp.parse(query)
             
     @staticmethod
-    def search(query, indexname=None, fields=None, limit=10, discriminators=None, exclude_discriminators=None, schema=None):
-        index = Index.get_index(indexname=indexname, schema=schema)
-        
-        if exclude_discriminators and discriminators:
-            q = And([Index.build_query(index, query, indexname=indexname, fields=fields), Not(Or([Term("discriminator", discriminator) for discriminator in discriminators]))])            
-        elif discriminators:
-            q = And([Index.build_query(index, query, indexname=indexname, fields=fields), Or([Term("discriminator", discriminator) for discriminator in discriminators])])
-        else:
-            q = Index.build_query(index, query, indexname=indexname, fields=fields)
-            
-        return index.searcher().search(q, limit=limit)
+    def search(query, indexname=None, fields=None, limit=10, discriminators=None, exclude_discriminators=None, schema=None, uuids=None):
+        """uuids, if given, restricts hits to documents with these uuids"""
+        if Index.sharding:
+            return Index.get_sharded(indexname, schema).search(query, fields, limit, discriminators, exclude_discriminators, uuids)
+        index, pool = Index.get_cached(indexname=indexname, schema=schema)
+        q = Index.build_query(index, query, indexname=indexname, fields=fields)
+
+        def search(searcher):
+            return searcher.search(q, limit=limit, **Index.get_search_filter(index, searcher, discriminators, exclude_discriminators, uuids))
+
+        key = ('search', query, tuple(fields) if fields else None, tuple(sorted(discriminators or ())), bool(exclude_discriminators), limit)
+        # uuid sets follow the database, not the index generation
+        return Index._search(index, pool, key if uuids is None else None, search)
+
+    @staticmethod
+    def search_within(root, query, indexname=None, fields=None, limit=10, page=None, pagelen=20, discriminators=None, exclude_discriminators=None,
+                      group=None, relation_type=None, max_depth=None, include_root=False, schema=None):
+        """Search the documents of root's descendants. The descendant uuids are
+        read in one query and applied as a filter, so limit and pages are
+        counted within the subtree. Returns search_page results when page is given.
+        group/relation_type filter the traversed edges like get_descendants."""
+        uuids = root.get_descendant_uuids(group, relation_type, max_depth)
+        if include_root:
+            uuids.add(root.uuid)
+        if page is not None:
+            return Index.search_page(query, indexname=indexname, page=page, pagelen=pagelen, fields=fields, schema=schema,
+                                     discriminators=discriminators, exclude_discriminators=exclude_discriminators, uuids=uuids)
+        return Index.search(query, indexname=indexname, fields=fields, limit=limit, discriminators=discriminators,
+                            exclude_discriminators=exclude_discriminators, schema=schema, uuids=uuids)
+
+    @staticmethod
+    def get_search_filter(index, searcher, discriminators=None, exclude_discriminators=None, uuids=None):
+        """Search kws for discriminators (see get_discriminator_filter) and uuids"""
+        kws = Index.get_discriminator_filter(index, searcher, discriminators, exclude_discriminators)
+        if uuids is not None:
+            docs = Index.get_uuid_docs(searcher, uuids)
+            kws['filter'] = kws['filter'] & docs if 'filter' in kws else docs
+        return kws
+
+    @staticmethod
+    def get_uuid_docs(searcher, uuids):
+        """Set of the searcher's docnums with a uuid in uuids"""
+        reader = searcher.reader()
+        docs = set()
+        for uuid_string in uuids:
+            uuid_string = unicode(uuid_string)
+            if ('uuid', uuid_string) in reader:
+                docs.update(reader.postings('uuid', uuid_string).all_ids())
+        return docs
+
+    @staticmethod
+    def get_discriminator_filter(index, searcher, discriminators=None, exclude_discriminators=None):
+        """Search kws restricting hits to (or, excluding, from) discriminators.
+        filter/mask only select documents, they are not scored."""
+        if not discriminators:
+            return {}
+        docs = Index.get_discriminator_docs(index, searcher, discriminators)
+        return {'mask': docs} if exclude_discriminators else {'filter': docs}
+
+    @staticmethod
+    def get_discriminator_docs(index, searcher, discriminators):
+        """Set of the searcher's docnums having any of discriminators, per
+        discriminator sets are cached for the reader generation"""
+        key = get_index_key(index) + (searcher.reader().generation(), )
+        docs = set()
+        for discriminator in discriminators:
+            discriminator_docs = discriminator_cache.get(key + (discriminator, ))
+            if discriminator_docs is None:
+                discriminator_docs = frozenset(searcher.docs_for_query(Term("discriminator", discriminator)))
+                discriminator_cache.set(key + (discriminator, ), discriminator_docs)
+            docs.update(discriminator_docs)
+        return docs
+
+    @staticmethod
+    def _search(index, pool, key, search):
+        if not Index.use_result_cache or key is None:
+            return Index._pooled_search(pool, search)
+        key = get_index_key(index) + key
+        # read before searching, a newer searcher only makes the entry stale sooner
+        generation = index.latest_generation()
+        results = result_cache.get(key, generation)
+        if results is None:
+            searcher = pool.acquire()
+            try:
+                results = search(searcher)
+                results = CachedResultsPage.from_page(results) if hasattr(results, 'pagenum') else CachedResults.from_results(results)
+            finally:
+                pool.release(searcher)
+            result_cache.set(key, generation, results)
+        return results
+
+    @staticmethod
+    def get_cache_stats():
+        return {'results': result_cache.get_stats(), 'queries': query_cache.get_stats(), 'discriminators': discriminator_cache.get_stats()}
+
+    @staticmethod
+    def _pooled_search(pool, search):
+        searcher = pool.acquire()
+        try:
+            results = search(searcher)
+        except Exception:
+            pool.release(searcher)
+            raise
+        # ResultsPage keeps its Results
+        pool.lend(searcher, getattr(results, 'results', results))
+        return results
             
     @staticmethod
-    def search_page(query, indexname=None, page=1, pagelen=20, fields=None, schema=None):
-        index = Index.get_index(indexname=indexname, schema=schema)
+    def search_page(query, indexname=None, page=1, pagelen=20, fields=None, schema=None, discriminators=None, exclude_discriminators=None, uuids=None):
+        if Index.sharding:
+            return Index.get_sharded(indexname, schema).search_page(query, page, pagelen, fields, discriminators, exclude_discriminators, uuids)
+        index, pool = Index.get_cached(indexname=indexname, schema=schema)
         q = Index.build_query(index, query, indexname=indexname, fields=fields)
-        return index.searcher().search_page(q, page, pagelen=pagelen)
\ No newline at end of file
+
+        def search(searcher):
+            return searcher.search_page(q, page, pagelen=pagelen, **Index.get_search_filter(index, searcher, discriminators, exclude_discriminators, uuids))
+
+        key = ('search_page', query, tuple(fields) if fields else None, tuple(sorted(discriminators or ())), bool(exclude_discriminators), page, pagelen)
+        return Index._search(index, pool, key if uuids is None else None, search)
+
+
+class ShardedIndex(object):
+    """Documents split over indexes named u'{indexname}.{n}', by crc32 of the
+    uuid or of the discriminator. Searches run on every shard (only the
+    shards of the discriminators, when sharded by them) in a thread pool and
+    merge the top hits by score. Scores use per shard term statistics.
+    Results are CachedResults(Page), hit.shard and hit.docnum locate a hit."""
+
+    UUID = 'uuid'
+    DISCRIMINATOR = 'discriminator'
+
+    def __init__(self, indexname=None, shards=4, shard_by=UUID, schema=None):
+        super(ShardedIndex, self).__init__()
+        assert shard_by in (self.UUID, self.DISCRIMINATOR)
+        self.indexname = indexname or u'default'
+        self.shards = shards
+        self.shard_by = shard_by
+        self.schema = schema
+        self.shard_names = [u'{0}.{1}'.format(self.indexname, n) for n in xrange(shards)]
+        self.thread_pool = ThreadPool(shards)
+
+    def get_shard_name(self, value):
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+        return self.shard_names[(zlib.crc32(value or '') & 0xffffffff) % self.shards]
+
+    def route(self, method, *args, **kws):
+        """[(shard name, method, args, kws)] for a writer method"""
+        if method == 'delete_by_term':
+            if args[0] == self.shard_by == self.UUID:
+                return [(self.get_shard_name(args[1]), method, args, kws)]
+            return [(name, method, args, kws) for name in self.shard_names]
+        shard_name = self.get_shard_name(kws.get(self.shard_by))
+        operations = [(shard_name, method, args, kws)]
+        if method == 'update_document' and self.shard_by == self.DISCRIMINATOR and kws.get('uuid'):
+            # the discriminator may have changed
+            operations += [(name, 'delete_by_term', ('uuid', kws['uuid']), {}) for name in self.shard_names if name != shard_name]
+        return operations
+
+    def write(self, method, *args, **kws):
+        for shard_name, method, args, kws in self.route(method, *args, **kws):
+            writer = Index.get_writer(indexname=shard_name, schema=self.schema)
+            getattr(writer, method)(*args, **kws)
+            Index._commit(writer)
+
+    def clean(self):
+        for shard_name in self.shard_names:
+            Index.get_index(indexname=shard_name, clean=True, schema=self.schema)
+
+    def get_search_shards(self, discriminators=None, exclude_discriminators=None):
+        if self.shard_by == self.DISCRIMINATOR and discriminators and not exclude_discriminators:
+            return sorted(set(self.get_shard_name(discriminator) for discriminator in discriminators))
+        return self.shard_names
+
+    def search(self, query, fields=None, limit=10, discriminators=None, exclude_discriminators=None, uuids=None):
+        def merge(shard_results):
+            hits = self._merge_hits([hits for hits, total in shard_results], limit)
+            return CachedResults(hits, sum(total for hits, total in shard_results))
+
+        key = ('search', query, tuple(fields) if fields else None, tuple(sorted(discriminators or ())), bool(exclude_discriminators), limit)
+        return self._search(key, query, fields, limit, discriminators, exclude_discriminators, uuids, merge)
+
+    def search_page(self, query, page=1, pagelen=20, fields=None, discriminators=None, exclude_discriminators=None, uuids=None):
+        if page < 1:
+            raise ValueError("pagenum must be >= 1")
+
+        def merge(shard_results):
+            hits = self._merge_hits([hits for hits, total in shard_results], page * pagelen)
+            return CachedResultsPage.from_top_hits(hits, sum(total for hits, total in shard_results), page, pagelen)
+
+        key = ('search_page', query, tuple(fields) if fields else None, tuple(sorted(discriminators or ())), bool(exclude_discriminators), page, pagelen)
+        # every shard returns its top page * pagelen, enough for any merged page
+        return self._search(key, query, fields, page * pagelen, discriminators, exclude_discriminators, uuids, merge)
+
+    def _search(self, key, query, fields, limit, discriminators, exclude_discriminators, uuids, merge):
+        shard_names = self.get_search_shards(discriminators, exclude_discriminators)
+
+        def search_shard(shard_name):
+            index, pool = Index.get_cached(indexname=shard_name, schema=self.schema)
+            q = Index.build_query(index, query, fields=fields)
+            searcher = pool.acquire()
+            try:
+                results = searcher.search(q, limit=limit, **Index.get_search_filter(index, searcher, discriminators, exclude_discriminators, uuids))
+                return get_cached_hits(results, shard_name), len(results)
+            finally:
+                pool.release(searcher)
+
+        if not Index.use_result_cache or uuids is not None:
+            return merge(self.thread_pool.map(search_shard, shard_names))
+        key = ('sharded', self.indexname, self.shards, self.shard_by) + key
+        generation = tuple(Index.get_index(indexname=shard_name, schema=self.schema).latest_generation() for shard_name in self.shard_names)
+        results = result_cache.get(key, generation)
+        if results is None:
+            results = merge(self.thread_pool.map(search_shard, shard_names))
+            result_cache.set(key, generation, results)
+        return results
+
+    @staticmethod
+    def _merge_hits(shard_hits, limit=None):
+        # sorted() is stable, equal scores keep shard order
+        hits = sorted((hit for hits in shard_hits for hit in hits), key=lambda hit: -hit.score)
+        if limit is not None:
+            hits = hits[:limit]
+        for rank, hit in enumerate(hits):
+            hit.rank = rank
+        return hits
+
+    def close(self):
+        self.thread_pool.close()
+        self.thread_pool.join()
+
+
+class IndexSync(object):
+    """Opt-in sync of AbstractNode inserts, updates and deletes to the index.
+
+    sync = IndexSync()
+    sync.enable(db_util.sessionmaker)  # or a session
+
+    Nodes are indexed with node.get_search_document(), a dict for the schema
+    (including uuid) or None to leave the node out, classes without it are
+    skipped. Documents are built at flush and handed to the index BatchWriter
+    when the transaction commits, its thread writes them. Rolled back
+    transactions and savepoints are dropped. Core bulk writes (node.importer)
+    are not seen."""
+
+    INFO_KEY = 'node.index_sync'
+    PENDING_KEY = 'node.index_sync.pending'
+
+    def __init__(self, indexname=None, schema=None, path=None, **kws):
+        super(IndexSync, self).__init__()
+        self.indexname = indexname
+        self.schema = schema
+        self.path = path
+        self.batch_writer_kws = kws
+        # by indexname, one per shard with Index.sharding
+        self.batch_writers = {}
+        self.upserts = 0
+        self.deletes = 0
+        self.rejected = 0
+
+    def get_batch_writer(self, indexname=None):
+        batch_writer = self.batch_writers.get(indexname)
+        if batch_writer is None or batch_writer.closed:
+            batch_writer = self.batch_writers[indexname] = Index.get_batch_writer(indexname=indexname, schema=self.schema, path=self.path, **self.batch_writer_kws)
+        return batch_writer
+
+    def enable(self, target):
+        if isinstance(target, sessionmaker):
+            target.configure(info=dict(target.kw.get('info') or {}, **{IndexSync.INFO_KEY: self}))
+        else:
+            target.info[IndexSync.INFO_KEY] = self
+
+    @staticmethod
+    def disable(session):
+        session.info.pop(IndexSync.PENDING_KEY, None)
+        return session.info.pop(IndexSync.INFO_KEY, None)
+
+    @staticmethod
+    def get_sync(session):
+        return session.info.get(IndexSync.INFO_KEY)
+
+    @staticmethod
+    def get_document(node):
+        get_search_document = getattr(node, 'get_search_document', None)
+        if get_search_document is None:
+            return False
+        return get_search_document()
+
+    def submit(self, documents):
+        """documents: {uuid: document, or None to delete}. A document the
+        BatchWriter refuses (e.g. UnknownFieldError) is skipped, the others are
+        submitted. The first error is then passed to on_error, or raised."""
+        sharded_index = Index.get_sharded(self.indexname, self.schema) if Index.sharding else None
+        error = None
+        for uuid_string, document in documents.iteritems():
+            if document is None:
+                operation = ('delete_by_term', ('uuid', unicode(uuid_string)), {})
+            else:
+                operation = ('update_document', (), to_unicode(dict(document)))
+            try:
+                if sharded_index is None:
+                    getattr(self.get_batch_writer(self.indexname), operation[0])(*operation[1], **operation[2])
+                else:
+                    for shard_name, method, args, kws in sharded_index.route(operation[0], *operation[1], **operation[2]):
+                        getattr(self.get_batch_writer(shard_name), method)(*args, **kws)
+            except Exception as e:
+                self.rejected += 1
+                error = error or e
+                continue
+            if document is None:
+                self.deletes += 1
+            else:
+                self.upserts += 1
+        if error is not None:
+            on_error = self.batch_writer_kws.get('on_error')
+            if on_error is None:
+                raise error
+            on_error(error)
+
+    def get_stats(self):
+        return {
+            'upserts': self.upserts,
+            'deletes': self.deletes,
+            'rejected': self.rejected,
+            'writers': dict((indexname or u'default', batch_writer.stats.as_dict()) for indexname, batch_writer in self.batch_writers.items())
+        }
+
+    @staticmethod
+    def _get_boundary(transaction):
+        # flushes run in subtransactions, documents belong to the savepoint or root
+        while transaction.parent is not None and not transaction.nested:
+            transaction = transaction.parent
+        return transaction
+
+    @staticmethod
+    def after_flush(session, flush_context):
+        if IndexSync.get_sync(session) is None:
+            return
+        pending = session.info.setdefault(IndexSync.PENDING_KEY, {})
+        documents = pending.setdefault(IndexSync._get_boundary(session.transaction), {})
+        for node in session.new:
+            if isinstance(node, AbstractNode):
+                document = IndexSync.get_document(node)
+                if document:
+                    documents[node.uuid] = document
+        for node in session.dirty:
+            if isinstance(node, AbstractNode) and session.is_modified(node, include_collections=False):
+                document = IndexSync.get_document(node)
+                if document is not False:
+                    documents[node.uuid] = document
+        for node in session.deleted:
+            if isinstance(node, AbstractNode) and IndexSync.get_document(node) is not False:
+                documents[node.uuid] = None
+
+    @staticmethod
+    def after_commit(session):
+        pending = session.info.get(IndexSync.PENDING_KEY)
+        if not pending:
+            return
+        transaction = IndexSync._get_boundary(session.transaction)
+        documents = pending.pop(transaction, None)
+        if not documents:
+            return
+        if transaction.parent is not None:
+            # released savepoint, commits with the enclosing transaction
+            pending.setdefault(IndexSync._get_boundary(transaction.parent), {}).update(documents)
+        else:
+            IndexSync.get_sync(session).submit(documents)
+
+    @staticmethod
+    def after_transaction_end(session, transaction):
+        pending = session.info.get(IndexSync.PENDING_KEY)
+        if pending:
+            # left over when rolled back
+            pending.pop(transaction, None)
+
+
+event.listen(Session, 'after_flush', IndexSync.after_flush)
+event.listen(Session, 'after_commit', IndexSync.after_commit)
+event.listen(Session, 'after_transaction_end', IndexSync.after_transaction_end)
+
+
+class ReindexStats(object):
+
+    def __init__(self):
+        super(ReindexStats, self).__init__()
+        self.chunks = 0
+        self.nodes = 0
+        self.documents = 0
+        self.started_at = time.time()
+
+    @property
+    def elapsed(self):
+        return time.time() - self.started_at
+
+    def __str__(self):
+        return '{0} documents from {1} nodes in {2} chunks, {3:.1f}s'.format(self.documents, self.nodes, self.chunks, self.elapsed)
+
+
+class Reindexer(object):
+    """Rebuilds an index from every node in the database.
+
+    Nodes are read in uuid ranges of chunk_size, documents are built with
+    node.get_search_document() by procs worker processes, each with its own
+    engine from conf (a DBUtil config). Documents are written by whoosh's
+    multi-process writer (writer_procs) and committed with the CLEAR merge
+    policy: the old segments are replaced in the same TOC commit, so searches
+    use the old index until the rebuild is done. Pooled searchers pick up the
+    new generation on refresh."""
+
+    def __init__(self, conf, indexname=None, schema=None, path=None, chunk_size=1000, procs=None, writer_procs=None, writer_batchsize=100, multisegment=False):
+        super(Reindexer, self).__init__()
+        self.conf = conf
+        self.indexname = indexname
+        self.schema = schema
+        self.path = path
+        self.chunk_size = chunk_size
+        self.procs = procs or multiprocessing.cpu_count()
+        self.writer_procs = writer_procs or self.procs
+        self.writer_batchsize = writer_batchsize
+        self.multisegment = multisegment
+        self.stats = ReindexStats()
+
+    def run(self):
+        ranges = self.get_ranges()
+        # with Index.sharding, one writer per shard, each shard is swapped on its own
+        sharded_index = Index.get_sharded(self.indexname, self.schema) if Index.sharding else None
+        writers = {}
+        for indexname in sharded_index.shard_names if sharded_index else [self.indexname]:
+            ix = Index.get_index(indexname=indexname, schema=self.schema, path=self.path)
+            writers[indexname] = ix.writer(procs=self.writer_procs, batchsize=self.writer_batchsize, multisegment=self.multisegment)
+        pool = multiprocessing.Pool(self.procs, initializer=_init_reindex_worker, initargs=(self.conf, ))
+        try:
+            for node_count, documents in pool.imap(_build_documents, ranges):
+                self.stats.chunks += 1
+                self.stats.nodes += node_count
+                self.stats.documents += len(documents)
+                for document in documents:
+                    indexname = sharded_index.get_shard_name(document.get(sharded_index.shard_by)) if sharded_index else self.indexname
+                    writers[indexname].add_document(**document)
+            pool.close()
+        except:
+            pool.terminate()
+            for writer in writers.values():
+                writer.cancel()
+            raise
+        finally:
+            pool.join()
+        for writer in writers.values():
+            writer.commit(mergetype=CLEAR)
+        return self.stats
+
+    def get_ranges(self):
+        """[(after uuid or None, up to uuid or None)] of chunk_size nodes"""
+        db_util = DBUtil(self.conf)
+        db_util.init_sessionmaker()
+        session = db_util.new_session()
+        node_cls = AbstractNode.get_node_cls()
+        uuid_column = node_cls.__table__.c.uuid
+        ranges = []
+        after_uuid = None
+        try:
+            result = session.execute(select([uuid_column]).order_by(uuid_column).execution_options(stream_results=True), mapper=node_cls)
+            for i, (uuid_string, ) in enumerate(result, 1):
+                if i % self.chunk_size == 0:
+                    ranges.append((after_uuid, uuid_string))
+                    after_uuid = uuid_string
+            ranges.append((after_uuid, None))
+        finally:
+            session.close()
+        return ranges
+
+
+# per process session factory of Reindexer workers
+_reindex_db_util = None
+
+def _init_reindex_worker(conf):
+    global _reindex_db_util
+    # forked from the parent, do not share its pooled connections
+    EngineRegistry.forget_all()
+    _reindex_db_util = DBUtil(conf)
+    _reindex_db_util.init_sessionmaker()
+
+def _build_documents(uuid_range):
+    after_uuid, up_to_uuid = uuid_range
+    node_cls = AbstractNode.get_node_cls()
+    session = _reindex_db_util.new_session()
+    try:
+        query = session.query(node_cls)
+        if after_uuid is not None:
+            query = query.filter(node_cls.uuid > after_uuid)
+        if up_to_uuid is not None:
+            query = query.filter(node_cls.uuid <= up_to_uuid)
+        documents = []
+        node_count = 0
+        for node in query.order_by(node_cls.uuid):
+            node_count += 1
+            document = IndexSync.get_document(node)
+            if document:
+                documents.append(to_unicode(dict(document)))
+        return node_count, documents
+    finally:
+        session.close()
\ No newline at end of file
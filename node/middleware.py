@@ -1,7 +1,10 @@
 # -*- coding: utf-8 -*-
-from sqlalchemy.orm import sessionmaker
-from sqlalchemy import create_engine, event
-from db_util import DBUtil
+import time
+
+from sqlalchemy.orm import sessionmaker, Session
+from sqlalchemy import event
+from db_util import DBUtil, EngineRegistry, RoutingSession
+from profiling import QueryProfiler
 
 # conf.yaml
 # db_url: mysql://root@localhost:3306/
@@ -12,33 +15,166 @@ from db_util import DBUtil
 #     pool_recycle: 3600
 #     echo: False
 
+class TimedSession(Session):
+    """Session adding up time spent holding a connection and waiting for one"""
+
+    def __init__(self, *args, **kws):
+        super(TimedSession, self).__init__(*args, **kws)
+        self.connection_time = 0.0
+        self.pool_wait_time = 0.0
+        self._bind_requested_at = None
+        self._connected_at = None
+        event.listen(self, 'after_begin', TimedSession._after_begin)
+        event.listen(self, 'after_transaction_end', TimedSession._after_transaction_end)
+
+    def get_bind(self, *args, **kws):
+        # called right before a connection is checked out
+        if self._connected_at is None:
+            self._bind_requested_at = time.time()
+        return super(TimedSession, self).get_bind(*args, **kws)
+
+    @staticmethod
+    def _after_begin(session, transaction, connection):
+        if session._connected_at is None:
+            session._connected_at = time.time()
+            if session._bind_requested_at is not None:
+                session.pool_wait_time += session._connected_at - session._bind_requested_at
+                session._bind_requested_at = None
+
+    @staticmethod
+    def _after_transaction_end(session, transaction):
+        # connections go back to the pool when the outermost transaction ends
+        if transaction.parent is None and session._connected_at is not None:
+            session.connection_time += time.time() - session._connected_at
+            session._connected_at = None
+
+
+class TimedRoutingSession(TimedSession, RoutingSession):
+    pass
+
+
+class RequestStats(object):
+
+    def __init__(self):
+        super(RequestStats, self).__init__()
+        self.sessions_opened = 0
+        self.connection_time = 0.0
+        self.pool_wait_time = 0.0
+        # QueryProfiler when profiling is enabled
+        self.profiler = None
+
+    def as_dict(self):
+        stats = {
+            'sessions_opened': self.sessions_opened,
+            'connection_time': self.connection_time,
+            'pool_wait_time': self.pool_wait_time
+        }
+        if self.profiler is not None:
+            stats['queries'] = self.profiler.get_summary()
+        return stats
+
+
+class LazySession(object):
+    """Stands in for the request session in environ. The session is created on
+    first attribute access. This is a proxy, not a Session: use get_session() for
+    isinstance checks or to compare with object_session(obj)."""
+
+    def __init__(self, sessionmaker, stats):
+        super(LazySession, self).__init__()
+        self._sessionmaker = sessionmaker
+        self._session = None
+        self.stats = stats
+
+    @property
+    def is_opened(self):
+        return self._session is not None
+
+    def get_session(self):
+        if self._session is None:
+            self._session = self._sessionmaker()
+            self.stats.sessions_opened += 1
+            if self.stats.profiler is not None:
+                self.stats.profiler.attach(self._session)
+        return self._session
+
+    def __getattr__(self, attr):
+        return getattr(self.get_session(), attr)
+
+    def close(self):
+        if self._session is not None:
+            self._session.close()
+            self.stats.connection_time += getattr(self._session, 'connection_time', 0.0)
+            self.stats.pool_wait_time += getattr(self._session, 'pool_wait_time', 0.0)
+            if self.stats.profiler is not None:
+                self.stats.profiler.detach(self._session)
+            self._session = None
+
+
+class ClosingIterator(object):
+    """Response iterable calling callback once the server closes it"""
+
+    def __init__(self, iterable, callback):
+        super(ClosingIterator, self).__init__()
+        self.iterable = iterable
+        self.iterator = iter(iterable)
+        self.callback = callback
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        return self.iterator.next()
+
+    def close(self):
+        try:
+            if hasattr(self.iterable, 'close'):
+                self.iterable.close()
+        finally:
+            self.callback()
+
+
 class NodeMiddleware(object):
+    """Puts a LazySession in environ[environ_key] and its RequestStats in
+    environ[environ_key + '.stats']. The session is closed when the response
+    iterable is closed, so streamed bodies can keep querying. on_request_stats,
+    if given, is called with the RequestStats of each request.
 
-    def __init__(self, app, environ_key='node.session', **kws):
+    profile, True or a dict of QueryProfiler arguments, profiles the statements
+    of each request: the QueryProfiler is in environ[environ_key + '.profile']
+    and its summary under 'queries' in RequestStats.as_dict()."""
+
+    def __init__(self, app, environ_key='node.session', on_request_stats=None, profile=False, **kws):
         self.app = app
-        self.config = kws
+        self.config = DBUtil.normalize_conf(kws)
         self.environ_key = environ_key
-        self.sessionmaker = sessionmaker(autoflush=False)
-        self.engine = create_engine(DBUtil.get_engine_url(self.config), **self.config.get('engine_params'))
-        self.sessionmaker.configure(bind=self.engine)
-
-        def on_engine_connect(dbapi_conn, conn_record):
-            print "on_engine_connect() SET charset & collate"
-            cursor = dbapi_conn.cursor()
-            cursor.execute("SET NAMES '{0}' COLLATE '{1}'".format(self.config.get('db_charset'), self.config.get('db_collate')))
-            cursor.execute("SET CHARACTER SET {0}".format(self.config.get('db_charset')))
-            cursor.execute("SET character_set_connection={0}".format(self.config.get('db_charset')))
+        self.on_request_stats = on_request_stats
+        self.profile = {} if profile is True else profile
+        # shares the pool with a DBUtil built from the same config
+        self.engine = EngineRegistry.get_engine(self.config)
+        session_params = dict({'class_': TimedSession}, **DBUtil.get_routing_params(self.config, TimedRoutingSession))
+        self.sessionmaker = sessionmaker(autoflush=False, bind=self.engine, **session_params)
 
-        event.listen(self.engine, 'connect', on_engine_connect)
+    def get_pool_metrics(self):
+        return EngineRegistry.get_metrics(self.config)
 
     def __call__(self, environ, start_response):
+        stats = RequestStats()
+        session = LazySession(self.sessionmaker, stats)
+        environ[self.environ_key] = session
+        environ[self.environ_key + '.stats'] = stats
+        if self.profile is not False:
+            stats.profiler = QueryProfiler(**self.profile)
+            environ[self.environ_key + '.profile'] = stats.profiler
         try:
-            # get session
-            environ[self.environ_key] = self.sessionmaker()
             # wsgi call
             response = self.app(environ, start_response)
-            # return response
-            return response
-        finally:
-            # close session
-            environ[self.environ_key].close()
+        except Exception:
+            self._end_request(session)
+            raise
+        # close session once the body is consumed
+        return ClosingIterator(response, lambda: self._end_request(session))
+
+    def _end_request(self, session):
+        session.close()
+        if self.on_request_stats:
+            self.on_request_stats(session.stats)
@@ -1,15 +1,24 @@
 # -*- coding: utf-8 -*-
 import datetime
+import sqlite3
+import sys
 import uuid
+from collections import defaultdict
+from types import FunctionType
+from operator import attrgetter
 from dateutil.tz import tzutc
 
-from sqlalchemy import Column, Integer, Unicode, ForeignKey, and_, or_, TypeDecorator, DateTime
-from sqlalchemy.orm import relationship
+from sqlalchemy import Column, Integer, Unicode, UnicodeText, ForeignKey, Index, and_, or_, TypeDecorator, DateTime, select, literal, func, bindparam, event, type_coerce, inspect
+from sqlalchemy.orm import relationship, column_property, deferred, Session
+from sqlalchemy.orm.attributes import InstrumentedAttribute
+from sqlalchemy.orm.interfaces import MapperProperty
+from sqlalchemy.orm.attributes import get_history, set_committed_value
+from sqlalchemy.orm.util import identity_key
 from sqlalchemy.orm.session import object_session
 from sqlalchemy.ext.mutable import MutableDict
 
 from node import Base
-from node.util import get_discriminators, JSONEncodedObj, validate_uuid4
+from node.util import get_discriminators, get_discriminator_set, get_class_cached, JSONEncodedObj, validate_uuid4, simplejson_dumps
 
 
 class UTCDateTime(TypeDecorator):
@@ -34,6 +43,32 @@ def datetime_utc_now():
     return datetime.datetime.now(tz)
 
 
+def _public_property(private_name):
+    def fset(self, value):
+        setattr(self, private_name, value)
+    return property(attrgetter(private_name), fset)
+
+def mark_written(session):
+    """Route the session's reads to the primary for the rest of the transaction,
+    before reading what a write depends on, see RoutingSession.mark_written"""
+    if hasattr(session, 'mark_written'):
+        session.mark_written()
+
+def add_public_properties(cls):
+    """For each underscored column attribute or descriptor, e.g. _created_at or
+    _color = DictProperty('color', '_meta'), add a plain property created_at
+    reading and writing it, unless the name is taken. Methods are skipped."""
+    for klass in cls.__mro__:
+        for name, value in klass.__dict__.items():
+            if not name.startswith('_') or name.startswith('__'):
+                continue
+            if not isinstance(value, (Column, InstrumentedAttribute, MapperProperty)):
+                if not hasattr(value, '__get__') or isinstance(value, (FunctionType, staticmethod, classmethod)):
+                    continue
+            if not hasattr(cls, name[1:]):
+                setattr(cls, name[1:], _public_property(name))
+
+
 class Edge(Base):
     CHILD = u'child'
     PARENT = u'parent'
@@ -45,18 +80,23 @@ class Edge(Base):
     _group_name = Column('group_name', Unicode(100))
     _relation_type = Column('relation_type', Unicode(100))
     _index = Column('index', Integer)
-    _meta_data = Column('meta_data', MutableDict.as_mutable(JSONEncodedObj))
+    # deferred, the meta_data property decodes _meta_data_json on first read,
+    # meta_data of edges that are never read is never decoded
+    _meta_data = deferred(Column('meta_data', MutableDict.as_mutable(JSONEncodedObj)))
+    _meta_data_json = column_property(type_coerce(_meta_data.columns[0], UnicodeText), expire_on_flush=False)
 
     # Dates
     _created_at = Column('created_at', UTCDateTime())
     _modified_at = Column('modified_at', UTCDateTime())
 
-    left_uuid = Column(Unicode(36), ForeignKey('nodes.uuid'))
+    # active_history keeps the previous uuid when set on an expired edge,
+    # get_flushed_edges needs it to remove the old closure paths
+    left_uuid = column_property(Column(Unicode(36), ForeignKey('nodes.uuid')), active_history=True)
     parent = relationship('Node',
                           backref='children_relations',
                           primaryjoin='Edge.left_uuid==Node.uuid')
 
-    right_uuid = Column(Unicode(36), ForeignKey('nodes.uuid'))
+    right_uuid = column_property(Column(Unicode(36), ForeignKey('nodes.uuid')), active_history=True)
     child = relationship('Node',
                          backref='parent_relations',
                          primaryjoin='Edge.right_uuid==Node.uuid',
@@ -67,33 +107,29 @@ class Edge(Base):
         now = datetime_utc_now()
         self._created_at = now
         self._modified_at = now
-
-    # def __getattribute__(self, attr):
-    #     # _attr = '_{0}'.format(attr)
-    #     # if not hasattr(self, attr) and hasattr(self, _attr):
-    #     #     return super(AbstractNode, self).__getattribute__(_attr)
-
-    #     return super(AbstractNode, self).__getattribute__(attr)
-
-    def __getattr__(self, attr):
-        attr = '_{0}'.format(attr)
-        if attr in self.__class__.__dict__:
-            return getattr(self, attr)
-        else:
-            raise AttributeError
-
-    def __setattr__(self, attr, value):
-        if attr in self.__class__.__dict__ or attr == '_sa_instance_state':
-            object.__setattr__(self, attr, value)
-        else:
-            object.__setattr__(self, '_{0}'.format(attr), value)
+        if 'meta_data' not in kw:
+            self._meta_data = None
 
     @property
     def session(self):
         return object_session(self)
 
+    @property
+    def meta_data(self):
+        if '_meta_data' not in self.__dict__:
+            value = Edge.__table__.c.meta_data.type.loads(self._meta_data_json)
+            if value is not None:
+                value = MutableDict.coerce('_meta_data', value)
+                value._parents[self] = '_meta_data'
+            set_committed_value(self, '_meta_data', value)
+        return self._meta_data
+
+    @meta_data.setter
+    def meta_data(self, value):
+        self._meta_data = value
+
     def _set_metadata_value(self, key, value):
-        if not self._meta_data:
+        if not self.meta_data:
             self._meta_data = {}
         # Remove keys with value None
         if value is None:
@@ -112,15 +148,179 @@ class Edge(Base):
     # = STATIC METHODS =
     # ==================
 
+    # Cycle check strategy: None (auto), 'closure', 'cte' or 'bfs'
+    cycle_check_strategy = None
+    # Keep the edge_closure table in sync on flush, see EdgeClosure
+    use_closure_table = False
+    # meta_data keys queryable through meta_filter, see EdgeMetaIndex
+    indexed_meta_keys = frozenset()
+    # Max number of uuids per IN clause when walking frontiers
+    frontier_chunk_size = 500
+
     @staticmethod
-    def check_circular_reference(parent, child):
-        """docstring for check_circular_reference"""
+    def check_circular_reference(parent, child, max_depth=None):
+        """Raise if parent is child, or if parent is reachable from child
+        (i.e. adding the edge parent -> child would create a cycle).
+        max_depth limits how many levels below child are searched."""
         if parent and parent == child:
             raise Exception('Cirular reference')
-        # recursive find parent as child or grandchild
-        if parent and child:
-            for grandchild in child._get_children():
-                Edge.check_circular_reference(parent, grandchild)
+        if not (parent and child):
+            return
+        session = object_session(child) or object_session(parent)
+        if session is None:
+            # neither node is persisted, no edges to walk
+            return
+        mark_written(session)
+        if Edge.is_reachable(session, child.uuid, parent.uuid, max_depth=max_depth):
+            raise Exception('Cirular reference')
+
+    @staticmethod
+    def is_reachable(session, source_uuid, target_uuid, max_depth=None, strategy=None):
+        """Return True if target_uuid is a descendant of source_uuid. Uses one lookup
+        in the closure table when enabled, a single recursive CTE query where
+        supported, otherwise one query per BFS frontier."""
+        if source_uuid == target_uuid:
+            return True
+        if max_depth is not None and max_depth < 1:
+            return False
+        strategy = strategy or Edge.cycle_check_strategy
+        if strategy is None:
+            if Edge.use_closure_table:
+                strategy = 'closure'
+            else:
+                strategy = 'cte' if Edge.supports_recursive_cte(session) else 'bfs'
+        if strategy == 'closure':
+            return EdgeClosure.is_reachable(session, source_uuid, target_uuid, max_depth)
+        elif strategy == 'cte':
+            return Edge._is_reachable_cte(session, source_uuid, target_uuid, max_depth)
+        elif strategy == 'bfs':
+            return Edge._is_reachable_bfs(session, source_uuid, target_uuid, max_depth)
+        raise ValueError(u'Unknown cycle check strategy "{0}"'.format(strategy))
+
+    @staticmethod
+    def supports_recursive_cte(session):
+        dialect = session.get_bind(mapper=Edge.__mapper__).dialect
+        version = dialect.server_version_info or ()
+        if dialect.name == 'sqlite':
+            # pysqlite before python 3.6 reports no result columns for
+            # a WITH statement returning no rows
+            return sqlite3.sqlite_version_info >= (3, 8, 3) and sys.version_info >= (3, 6)
+        if dialect.name == 'mysql':
+            if getattr(dialect, '_is_mariadb', False):
+                return version >= (10, 2)
+            return version >= (8, 0)
+        return dialect.name in ('postgresql', 'mssql', 'oracle')
+
+    @staticmethod
+    def _is_reachable_cte(session, source_uuid, target_uuid, max_depth=None):
+        edges = Edge.__table__
+        if max_depth is None:
+            # UNION on uuid only, each node is visited once
+            seed = select([edges.c.right_uuid.label('uuid')]).where(edges.c.left_uuid == source_uuid)
+            reachable = seed.cte('reachable', recursive=True)
+            step = select([edges.c.right_uuid]).where(and_(edges.c.left_uuid == reachable.c.uuid,
+                                                           reachable.c.uuid != target_uuid))
+        else:
+            seed = select([edges.c.right_uuid.label('uuid'), literal(1).label('depth')]).where(edges.c.left_uuid == source_uuid)
+            reachable = seed.cte('reachable', recursive=True)
+            step = select([edges.c.right_uuid, reachable.c.depth + 1]).where(and_(edges.c.left_uuid == reachable.c.uuid,
+                                                                                 reachable.c.uuid != target_uuid,
+                                                                                 reachable.c.depth < max_depth))
+        reachable = reachable.union(step)
+        found = select([literal(1).label('found')]).select_from(reachable).where(reachable.c.uuid == target_uuid).limit(1)
+        # count() always returns one row, even when nothing is found
+        query = select([func.count()]).select_from(found.alias('found'))
+        return session.execute(query, mapper=Edge).scalar() > 0
+
+    @staticmethod
+    def _is_reachable_bfs(session, source_uuid, target_uuid, max_depth=None):
+        edges = Edge.__table__
+        visited = set([source_uuid])
+        frontier = [source_uuid]
+        depth = 0
+        while frontier and (max_depth is None or depth < max_depth):
+            depth += 1
+            next_frontier = []
+            for i in xrange(0, len(frontier), Edge.frontier_chunk_size):
+                chunk = frontier[i:i + Edge.frontier_chunk_size]
+                query = select([edges.c.right_uuid]).where(edges.c.left_uuid.in_(chunk)).distinct()
+                for (right_uuid, ) in session.execute(query, mapper=Edge):
+                    if right_uuid == target_uuid:
+                        return True
+                    if right_uuid not in visited:
+                        visited.add(right_uuid)
+                        next_frontier.append(right_uuid)
+            frontier = next_frontier
+        return False
+
+    @staticmethod
+    def get_traversal_cte(root_uuid, relation=CHILD, group=False, relation_type=False, max_depth=None, name='traversal'):
+        """Recursive CTE of (uuid, depth) for nodes reachable from root_uuid.
+        relation=CHILD walks down to descendants, PARENT walks up to ancestors.
+        group/relation_type filter every traversed edge, False matches any.
+        A node reached through several paths gets one row per distinct depth."""
+        edges = Edge.__table__
+        if relation == Edge.CHILD:
+            near, far = edges.c.left_uuid, edges.c.right_uuid
+        else:
+            near, far = edges.c.right_uuid, edges.c.left_uuid
+        clauses = Edge._get_edge_filter_clauses(group, relation_type)
+        seed = select([far.label('uuid'), literal(1).label('depth')]).where(and_(near == root_uuid, *clauses))
+        traversal = seed.cte(name, recursive=True)
+        step_clauses = [near == traversal.c.uuid] + clauses
+        if max_depth is not None:
+            step_clauses.append(traversal.c.depth < max_depth)
+        step = select([far, traversal.c.depth + 1]).where(and_(*step_clauses))
+        return traversal.union(step)
+
+    @staticmethod
+    def walk(session, root_uuid, relation=CHILD, group=False, relation_type=False, max_depth=None):
+        """Breadth first walk from root_uuid without CTEs, one query per frontier chunk.
+        Yields a list of (uuid, depth) per level, each node at its shortest depth."""
+        edges = Edge.__table__
+        if relation == Edge.CHILD:
+            near, far = edges.c.left_uuid, edges.c.right_uuid
+        else:
+            near, far = edges.c.right_uuid, edges.c.left_uuid
+        clauses = Edge._get_edge_filter_clauses(group, relation_type)
+        visited = set([root_uuid])
+        frontier = [root_uuid]
+        depth = 0
+        while frontier and (max_depth is None or depth < max_depth):
+            depth += 1
+            next_frontier = []
+            for i in xrange(0, len(frontier), Edge.frontier_chunk_size):
+                chunk = frontier[i:i + Edge.frontier_chunk_size]
+                query = select([far]).where(and_(near.in_(chunk), *clauses)).distinct()
+                for (uuid_string, ) in session.execute(query, mapper=Edge):
+                    if uuid_string not in visited:
+                        visited.add(uuid_string)
+                        next_frontier.append(uuid_string)
+            if next_frontier:
+                yield [(uuid_string, depth) for uuid_string in next_frontier]
+            frontier = next_frontier
+
+    @staticmethod
+    def get_reachable_uuids(session, root_uuid, relation=CHILD, group=False, relation_type=False, max_depth=None):
+        """Set of uuids below (CHILD) or above (PARENT) root_uuid, root excluded.
+        Reads only uuids, through the closure table, a recursive CTE or walk()."""
+        if Edge.use_closure_table and group is False and relation_type is False:
+            query = EdgeClosure.get_depths_select(root_uuid, relation, max_depth)
+        elif Edge.supports_recursive_cte(session):
+            query = select([Edge.get_traversal_cte(root_uuid, relation, group, relation_type, max_depth).c.uuid])
+        else:
+            return set(uuid_string for level in Edge.walk(session, root_uuid, relation, group, relation_type, max_depth) for uuid_string, depth in level)
+        return set(row[0] for row in session.execute(query, mapper=Edge))
+
+    @staticmethod
+    def _get_edge_filter_clauses(group=False, relation_type=False):
+        edges = Edge.__table__
+        clauses = []
+        if group is not False:
+            clauses.append(edges.c.group_name == group)
+        if relation_type is not False:
+            clauses.append(edges.c.relation_type == relation_type)
+        return clauses
 
     @staticmethod
     def create_edge(parent, child, group=None, relation_type=None, index=None, metadata=None):
@@ -129,7 +329,7 @@ class Edge(Base):
         if isinstance(child, int):
             child = AbstractNode.get(child)
         Edge.check_circular_reference(parent, child)  # raises error if fail
-        edge = Edge(metadata=metadata)
+        edge = Edge(meta_data=metadata)
         edge.parent = parent
         edge.child = child
         edge._group_name = group
@@ -140,66 +340,543 @@ class Edge(Base):
     @staticmethod
     def update_child_edges(parent, children, **kws):
         """Update parent's child edges. child_ids=[list of children], discriminators=[list of discriminators], group="name of edge group", metadata=[list of dicts] """
-        Edge.update_related_edges(parent, children, Edge.CHILD, **kws)
+        return Edge.update_related_edges(parent, children, Edge.CHILD, **kws)
 
     @staticmethod
     def update_parent_edges(child, parents, **kws):
         """Update child's parent edges. parents=[list of parents], discriminators=[list of discriminators], group="name of edge group", metadata=[list of dicts] """
-        Edge.update_related_edges(child, parents, Edge.PARENT, **kws)
+        return Edge.update_related_edges(child, parents, Edge.PARENT, **kws)
 
     @staticmethod
     def update_related_edges(node, related_nodes, relation=CHILD, discriminators=None, group=None, relation_type=None, metadata=None):
         """Update node's related parent or child edges. related_nodes=[list of related nodes],
         discriminators=[list of discriminators], group="name of edge group", relation_type="type of relation",
-        metadata=[list of dicts] """
+        metadata=[list of dicts]
+
+        Edges are diffed by uuid and written with one bulk DELETE, UPDATE and INSERT
+        on the session connection, pending objects are flushed first. Related nodes
+        without a session are added to node's session, like the ORM cascade would.
+        Returns a dict of related uuids: {'added': [...], 'updated': [...], 'removed': [...]}"""
         assert isinstance(related_nodes, list)
         # only allow unique nodes
-        uuids = [related_node.uuid for related_node in related_nodes]
-        assert len(uuids) == len(set(uuids))
-        clauses = (Edge.parent == node, ) if relation == Edge.CHILD else (Edge.child == node, )
-        if group is not False:
-            clauses = clauses + (Edge._group_name == group, )
-        if relation_type is not False:
-            clauses = clauses + (Edge._relation_type == relation_type, )
-        if discriminators:
-            # temp fix ?
-            subclasses = AbstractNode.__subclasses__()
-            if len(subclasses) > 1:
-                raise Exception('More than one subclass found for AbstractClass')
-            nodeCls = subclasses[0]
-            clauses = clauses + (nodeCls.discriminator.in_(discriminators), )
-
-        # iterate existing edges
+        positions = dict((related_node.uuid, i) for i, related_node in enumerate(related_nodes))
+        assert len(positions) == len(related_nodes)
+        edges = Edge.__table__
+        if relation == Edge.CHILD:
+            near, far = edges.c.left_uuid, edges.c.right_uuid
+        else:
+            near, far = edges.c.right_uuid, edges.c.left_uuid
+        clauses = [near == node.uuid] + Edge._get_edge_filter_clauses(group, relation_type)
+
         s = node.session
-        existing_edges = s.query(Edge).join(Edge.child if relation == Edge.CHILD else Edge.parent).filter(and_(*clauses)).all()
-        updated_nodes = []
-        for edge in existing_edges:
-            related_node = edge.child if relation == Edge.CHILD else edge.parent
-            if related_node in related_nodes:
-                i = related_nodes.index(related_node)  # index in list
-                if metadata:
-                    if i < len(metadata):
-                        edge.meta_data = metadata[i]  # set metadata on edge
-                edge._index = i
-                updated_nodes.append(related_node)
+        # the diff and cycle check must not read a lagging replica
+        mark_written(s)
+        for related_node in related_nodes:
+            related_session = object_session(related_node)
+            if related_session is None:
+                # the bulk INSERT bypasses the save-update cascade
+                s.add(related_node)
+            elif related_session is not s:
+                raise Exception(u'Related node {0} is attached to another session'.format(related_node.uuid))
+        s.flush()
+        query = select([edges.c.id, far, edges.c.index, edges.c.meta_data])
+        if discriminators:
+            node_table = AbstractNode.get_node_cls().__table__
+            query = query.select_from(edges.join(node_table, node_table.c.uuid == far))
+            clauses.append(node_table.c.discriminator.in_(discriminators))
+        existing = {}
+        removed = []
+        for edge_id, related_uuid, index, meta_data in s.execute(query.where(and_(*clauses)), mapper=Edge):
+            if related_uuid in positions and related_uuid not in existing:
+                existing[related_uuid] = (edge_id, index, meta_data)
             else:
-                s.delete(edge)
+                removed.append((edge_id, related_uuid))
 
-        # iterate non existing nodes and create new edges
-        for i, related_node in enumerate(related_nodes):
-            # already updated
-            if related_node in updated_nodes:
-                continue
-            md = metadata[i] if metadata and i < len(metadata) else None
-            if relation == Edge.CHILD:
-                new_edge = Edge.create_edge(node, related_node, group=group, relation_type=relation_type, index=i, metadata=md)
-            else:
-                new_edge = Edge.create_edge(related_node, node, group=group, relation_type=relation_type, index=i, metadata=md)
-            s.add(new_edge)
+        now = datetime_utc_now()
+        updates, updated = [], []
+        for related_uuid, (edge_id, index, meta_data) in existing.iteritems():
+            i = positions[related_uuid]
+            new_meta_data = metadata[i] if metadata and i < len(metadata) else meta_data
+            if index != i or new_meta_data != meta_data:
+                updates.append({'b_id': edge_id, 'b_index': i, 'b_meta_data': new_meta_data, 'b_modified_at': now})
+                updated.append(related_uuid)
+
+        added = [related_uuid for related_uuid in positions if related_uuid not in existing]
+        if added:
+            Edge.check_circular_references(node, added, relation)  # raises error if fail
+        inserts = []
+        for related_uuid in added:
+            i = positions[related_uuid]
+            inserts.append({
+                'left_uuid': node.uuid if relation == Edge.CHILD else related_uuid,
+                'right_uuid': related_uuid if relation == Edge.CHILD else node.uuid,
+                'group_name': group if group is not False else None,
+                'relation_type': relation_type if relation_type is not False else None,
+                'index': i,
+                'meta_data': metadata[i] if metadata and i < len(metadata) else None,
+                'created_at': now,
+                'modified_at': now
+            })
+
+        if removed:
+            removed_ids = [edge_id for edge_id, related_uuid in removed]
+            for i in xrange(0, len(removed_ids), Edge.frontier_chunk_size):
+                s.execute(edges.delete().where(edges.c.id.in_(removed_ids[i:i + Edge.frontier_chunk_size])), mapper=Edge)
+        if updates:
+            s.execute(edges.update().where(edges.c.id == bindparam('b_id')).values(index=bindparam('b_index'),
+                                                                                  meta_data=bindparam('b_meta_data', type_=edges.c.meta_data.type),
+                                                                                  modified_at=bindparam('b_modified_at', type_=edges.c.modified_at.type)),
+                      updates, mapper=Edge)
+        if inserts:
+            s.execute(edges.insert(), inserts, mapper=Edge)
+
+        if Edge.indexed_meta_keys:
+            # bulk statements bypass the flush hook
+            EdgeMetaIndex.delete(s, [edge_id for edge_id, related_uuid in removed])
+            meta_data_by_id = dict((update['b_id'], update['b_meta_data']) for update in updates)
+            if added:
+                query = select([edges.c.id, far, edges.c.meta_data]).where(and_(*([near == node.uuid] + Edge._get_edge_filter_clauses(group, relation_type))))
+                for i in xrange(0, len(added), Edge.frontier_chunk_size):
+                    chunk = added[i:i + Edge.frontier_chunk_size]
+                    for edge_id, related_uuid, meta_data in s.execute(query.where(far.in_(chunk)), mapper=Edge):
+                        meta_data_by_id[edge_id] = meta_data
+            EdgeMetaIndex.sync(s, meta_data_by_id)
+
+        if Edge.use_closure_table:
+            # bulk statements bypass the flush hook
+            for edge_id, related_uuid in removed:
+                EdgeClosure.remove_edge(s, *((node.uuid, related_uuid) if relation == Edge.CHILD else (related_uuid, node.uuid)))
+            for related_uuid in added:
+                EdgeClosure.add_edge(s, *((node.uuid, related_uuid) if relation == Edge.CHILD else (related_uuid, node.uuid)))
+
+        changed_uuids = [node.uuid] + added + [related_uuid for edge_id, related_uuid in removed]
+        cache = RelatedNodesCache.get_cache(s)
+        if cache is not None:
+            cache.invalidate(changed_uuids)
+        clear_prefetched_uuids(s, changed_uuids)
+
+        # loaded edges and relationship collections are stale
+        for edge_id, related_uuid in removed:
+            edge = s.identity_map.get(identity_key(Edge, edge_id))
+            if edge is not None:
+                s.expunge(edge)
+        for update in updates:
+            edge = s.identity_map.get(identity_key(Edge, update['b_id']))
+            if edge is not None:
+                s.expire(edge)
+        s.expire(node, ['children_relations' if relation == Edge.CHILD else 'parent_relations'])
+
+        return {
+            'added': added,
+            'updated': updated,
+            'removed': [related_uuid for edge_id, related_uuid in removed]
+        }
+
+    @staticmethod
+    def check_circular_references(node, related_uuids, relation=CHILD):
+        """Batched check_circular_reference for many new edges at once, related_uuids
+        being new children (CHILD) or new parents (PARENT) of node. One query,
+        looking for any of related_uuids among node's ancestors (or descendants)."""
+        if node.uuid in related_uuids:
+            raise Exception('Cirular reference')
+        session = node.session
+        mark_written(session)
+        opposite = Edge.PARENT if relation == Edge.CHILD else Edge.CHILD
+        if Edge.use_closure_table:
+            found = EdgeClosure.get_depths_select(node.uuid, opposite).alias('found')
+        elif Edge.supports_recursive_cte(session):
+            found = Edge.get_traversal_cte(node.uuid, opposite, group=False, relation_type=False, name='found')
+        else:
+            targets = set(related_uuids)
+            for level in Edge.walk(session, node.uuid, opposite, group=False, relation_type=False):
+                if any(uuid_string in targets for uuid_string, depth in level):
+                    raise Exception('Cirular reference')
+            return
+        for i in xrange(0, len(related_uuids), Edge.frontier_chunk_size):
+            chunk = related_uuids[i:i + Edge.frontier_chunk_size]
+            query = select([found.c.uuid]).select_from(found).where(found.c.uuid.in_(chunk)).limit(1)
+            if session.execute(query, mapper=Edge).first() is not None:
+                raise Exception('Cirular reference')
 
     @staticmethod
     def remove_all_edges(node):
-        node.session.query(Edge).filter(or_(Edge.left_uuid == node.uuid, Edge.right_uuid == node.uuid)).delete()
+        mark_written(node.session)
+        query = node.session.query(Edge).filter(or_(Edge.left_uuid == node.uuid, Edge.right_uuid == node.uuid))
+        if Edge.indexed_meta_keys:
+            EdgeMetaIndex.delete(node.session, [edge_id for (edge_id, ) in query.with_entities(Edge.id)])
+        # bulk delete bypasses the flush hooks
+        pairs = query.with_entities(Edge.left_uuid, Edge.right_uuid).all()
+        if Edge.use_closure_table:
+            for left_uuid, right_uuid in pairs:
+                EdgeClosure.remove_edge(node.session, left_uuid, right_uuid)
+        changed_uuids = [node.uuid] + [uuid_string for pair in pairs for uuid_string in pair]
+        cache = RelatedNodesCache.get_cache(node.session)
+        if cache is not None:
+            cache.invalidate(changed_uuids)
+        clear_prefetched_uuids(node.session, changed_uuids)
+        query.delete()
+
+    @staticmethod
+    def get_flushed_edges(session):
+        """In a flush hook, returns (removed, added, updated) lists of (left_uuid, right_uuid)
+        for edges being deleted, inserted or updated. Moved edges are both removed and added."""
+        removed, added, updated = [], [], []
+        for obj in session.deleted:
+            if isinstance(obj, Edge):
+                removed.append((obj.left_uuid, obj.right_uuid))
+        for obj in session.dirty:
+            if isinstance(obj, Edge):
+                left, right = get_history(obj, 'left_uuid'), get_history(obj, 'right_uuid')
+                if left.has_changes() or right.has_changes():
+                    old_left = left.deleted[0] if left.deleted else obj.left_uuid
+                    old_right = right.deleted[0] if right.deleted else obj.right_uuid
+                    removed.append((old_left, old_right))
+                    added.append((obj.left_uuid, obj.right_uuid))
+                elif session.is_modified(obj):
+                    updated.append((obj.left_uuid, obj.right_uuid))
+        for obj in session.new:
+            if isinstance(obj, Edge):
+                added.append((obj.left_uuid, obj.right_uuid))
+        return removed, added, updated
+
+
+class EdgeClosure(Base):
+    """Transitive closure of the edges graph, one row per (ancestor, descendant, depth)
+    with the number of distinct paths of that length. Counting paths lets an edge
+    delete be applied incrementally, as long as the graph stays acyclic.
+
+    Maintained on flush when Edge.use_closure_table is set. Rows are not
+    filtered on group or relation_type, every edge is traversed."""
+    __tablename__ = 'edge_closure'
+    __table_args__ = (Index('ix_edge_closure_descendant', 'descendant_uuid', 'depth'), )
+    ancestor_uuid = Column(Unicode(36), primary_key=True)
+    descendant_uuid = Column(Unicode(36), primary_key=True)
+    depth = Column(Integer, primary_key=True, autoincrement=False)
+    paths = Column(Integer, nullable=False, default=1)
+
+    @staticmethod
+    def is_reachable(session, source_uuid, target_uuid, max_depth=None):
+        closure = EdgeClosure.__table__
+        clauses = [closure.c.ancestor_uuid == source_uuid, closure.c.descendant_uuid == target_uuid]
+        if max_depth is not None:
+            clauses.append(closure.c.depth <= max_depth)
+        query = select([closure.c.depth]).where(and_(*clauses)).limit(1)
+        return session.execute(query, mapper=EdgeClosure).first() is not None
+
+    @staticmethod
+    def get_depths_select(root_uuid, relation=Edge.CHILD, max_depth=None):
+        """Select of (uuid, depth) for nodes below (CHILD) or above (PARENT) root_uuid,
+        each node at its shortest depth."""
+        closure = EdgeClosure.__table__
+        if relation == Edge.CHILD:
+            near, far = closure.c.ancestor_uuid, closure.c.descendant_uuid
+        else:
+            near, far = closure.c.descendant_uuid, closure.c.ancestor_uuid
+        clauses = [near == root_uuid]
+        if max_depth is not None:
+            clauses.append(closure.c.depth <= max_depth)
+        return select([far.label('uuid'), func.min(closure.c.depth).label('depth')]).where(and_(*clauses)).group_by(far)
+
+    @staticmethod
+    def add_edge(session, left_uuid, right_uuid):
+        EdgeClosure._apply_edge(session, left_uuid, right_uuid, 1)
+
+    @staticmethod
+    def remove_edge(session, left_uuid, right_uuid):
+        EdgeClosure._apply_edge(session, left_uuid, right_uuid, -1)
+
+    @staticmethod
+    def _apply_edge(session, left_uuid, right_uuid, sign):
+        """Add (sign=1) or remove (sign=-1) the paths through edge left -> right:
+        every ancestor of left (and left) times every descendant of right (and right)."""
+        if not (left_uuid and right_uuid):
+            return
+        closure = EdgeClosure.__table__
+        ancestors = [(left_uuid, 0, 1)] + list(session.execute(
+            select([closure.c.ancestor_uuid, closure.c.depth, closure.c.paths]).where(closure.c.descendant_uuid == left_uuid),
+            mapper=EdgeClosure))
+        descendants = [(right_uuid, 0, 1)] + list(session.execute(
+            select([closure.c.descendant_uuid, closure.c.depth, closure.c.paths]).where(closure.c.ancestor_uuid == right_uuid),
+            mapper=EdgeClosure))
+        deltas = defaultdict(int)
+        for ancestor_uuid, ancestor_depth, ancestor_paths in ancestors:
+            for descendant_uuid, descendant_depth, descendant_paths in descendants:
+                key = (ancestor_uuid, descendant_uuid, ancestor_depth + descendant_depth + 1)
+                deltas[key] += sign * ancestor_paths * descendant_paths
+
+        # existing rows for the affected pairs
+        existing = {}
+        descendant_uuids = list(set(row[0] for row in descendants))
+        ancestor_uuids = list(set(row[0] for row in ancestors))
+        for i in xrange(0, len(ancestor_uuids), Edge.frontier_chunk_size):
+            chunk = ancestor_uuids[i:i + Edge.frontier_chunk_size]
+            for j in xrange(0, len(descendant_uuids), Edge.frontier_chunk_size):
+                query = select([closure.c.ancestor_uuid, closure.c.descendant_uuid, closure.c.depth, closure.c.paths]).where(
+                    and_(closure.c.ancestor_uuid.in_(chunk),
+                         closure.c.descendant_uuid.in_(descendant_uuids[j:j + Edge.frontier_chunk_size])))
+                for ancestor_uuid, descendant_uuid, depth, paths in session.execute(query, mapper=EdgeClosure):
+                    existing[(ancestor_uuid, descendant_uuid, depth)] = paths
+
+        inserts, updates, deletes = [], [], []
+        for (ancestor_uuid, descendant_uuid, depth), delta in deltas.iteritems():
+            key = {'b_ancestor': ancestor_uuid, 'b_descendant': descendant_uuid, 'b_depth': depth}
+            paths = existing.get((ancestor_uuid, descendant_uuid, depth), 0) + delta
+            if paths <= 0:
+                if (ancestor_uuid, descendant_uuid, depth) in existing:
+                    deletes.append(key)
+            elif (ancestor_uuid, descendant_uuid, depth) in existing:
+                key['b_paths'] = paths
+                updates.append(key)
+            else:
+                inserts.append({'ancestor_uuid': ancestor_uuid, 'descendant_uuid': descendant_uuid, 'depth': depth, 'paths': paths})
+
+        row_clause = and_(closure.c.ancestor_uuid == bindparam('b_ancestor'),
+                          closure.c.descendant_uuid == bindparam('b_descendant'),
+                          closure.c.depth == bindparam('b_depth'))
+        if deletes:
+            session.execute(closure.delete().where(row_clause), deletes, mapper=EdgeClosure)
+        if updates:
+            session.execute(closure.update().where(row_clause).values(paths=bindparam('b_paths')), updates, mapper=EdgeClosure)
+        if inserts:
+            session.execute(closure.insert(), inserts, mapper=EdgeClosure)
+
+    @staticmethod
+    def after_flush(session, flush_context):
+        """Session 'after_flush' hook, applies flushed edge deletes, moves and inserts"""
+        if not Edge.use_closure_table:
+            return
+        removed, added, updated = Edge.get_flushed_edges(session)
+        for left_uuid, right_uuid in removed:
+            EdgeClosure.remove_edge(session, left_uuid, right_uuid)
+        for left_uuid, right_uuid in added:
+            EdgeClosure.add_edge(session, left_uuid, right_uuid)
+
+    @staticmethod
+    def rebuild(session):
+        """Recreate all closure rows from the edges table"""
+        closure = EdgeClosure.__table__
+        session.execute(closure.delete(), mapper=EdgeClosure)
+        rows = []
+        for ancestor_uuid, descendant_uuid, depth, paths in EdgeClosure._iter_expected_rows(session):
+            rows.append({'ancestor_uuid': ancestor_uuid, 'descendant_uuid': descendant_uuid, 'depth': depth, 'paths': paths})
+            if len(rows) >= Edge.frontier_chunk_size:
+                session.execute(closure.insert(), rows, mapper=EdgeClosure)
+                rows = []
+        if rows:
+            session.execute(closure.insert(), rows, mapper=EdgeClosure)
+
+    @staticmethod
+    def check(session):
+        """Compare the closure table with the edges table. Returns a list of
+        (ancestor_uuid, descendant_uuid, depth, expected_paths, actual_paths),
+        empty when consistent. Missing rows have 0 paths."""
+        closure = EdgeClosure.__table__
+        query = select([closure.c.ancestor_uuid, closure.c.descendant_uuid, closure.c.depth, closure.c.paths])
+        actual = dict(((a, d, depth), paths) for a, d, depth, paths in session.execute(query, mapper=EdgeClosure))
+        mismatches = []
+        for ancestor_uuid, descendant_uuid, depth, paths in EdgeClosure._iter_expected_rows(session):
+            actual_paths = actual.pop((ancestor_uuid, descendant_uuid, depth), 0)
+            if actual_paths != paths:
+                mismatches.append((ancestor_uuid, descendant_uuid, depth, paths, actual_paths))
+        for (ancestor_uuid, descendant_uuid, depth), actual_paths in actual.iteritems():
+            mismatches.append((ancestor_uuid, descendant_uuid, depth, 0, actual_paths))
+        return mismatches
+
+    @staticmethod
+    def _iter_expected_rows(session):
+        """Yield (ancestor, descendant, depth, paths) computed in memory from all edges"""
+        edges = Edge.__table__
+        adjacency = defaultdict(list)
+        query = select([edges.c.left_uuid, edges.c.right_uuid]).where(and_(edges.c.left_uuid != None, edges.c.right_uuid != None))
+        for left_uuid, right_uuid in session.execute(query, mapper=Edge):
+            adjacency[left_uuid].append(right_uuid)
+        for ancestor_uuid in adjacency.keys():
+            level = defaultdict(int)
+            for right_uuid in adjacency[ancestor_uuid]:
+                level[right_uuid] += 1
+            depth = 1
+            while level:
+                if depth > len(adjacency):
+                    raise Exception(u'Cirular reference below {0}'.format(ancestor_uuid))
+                next_level = defaultdict(int)
+                for descendant_uuid, paths in level.iteritems():
+                    yield ancestor_uuid, descendant_uuid, depth, paths
+                    for right_uuid in adjacency.get(descendant_uuid, ()):
+                        next_level[right_uuid] += paths
+                level = next_level
+                depth += 1
+
+
+event.listen(Session, 'after_flush', EdgeClosure.after_flush)
+
+
+def encode_meta_value(value):
+    """JSON text of an indexable value, None for dicts, lists and long values"""
+    if isinstance(value, (dict, list, tuple)):
+        return None
+    encoded = simplejson_dumps(value)
+    if len(encoded) > META_VALUE_LENGTH:
+        return None
+    return encoded
+
+META_VALUE_LENGTH = 191
+
+
+class EdgeMetaIndex(Base):
+    """Side table of Edge.meta_data values for keys in Edge.indexed_meta_keys,
+    kept in sync on flush. Answers meta_filter={'role': u'owner'} through an index.
+    Changing indexed_meta_keys requires EdgeMetaIndex.rebuild."""
+    __tablename__ = 'edge_meta_index'
+    __table_args__ = (Index('ix_edge_meta_index_lookup', 'key', 'value', 'edge_id'), )
+    edge_id = Column(Integer, primary_key=True, autoincrement=False)
+    key = Column(Unicode(100), primary_key=True)
+    value = Column(Unicode(META_VALUE_LENGTH))
+
+    @staticmethod
+    def get_rows(edge_id, meta_data):
+        rows = []
+        for key in Edge.indexed_meta_keys:
+            if meta_data and key in meta_data:
+                value = encode_meta_value(meta_data[key])
+                if value is not None:
+                    rows.append({'edge_id': edge_id, 'key': key, 'value': value})
+        return rows
+
+    @staticmethod
+    def delete(session, edge_ids):
+        table = EdgeMetaIndex.__table__
+        for i in xrange(0, len(edge_ids), Edge.frontier_chunk_size):
+            chunk = edge_ids[i:i + Edge.frontier_chunk_size]
+            session.execute(table.delete().where(table.c.edge_id.in_(chunk)), mapper=EdgeMetaIndex)
+
+    @staticmethod
+    def sync(session, meta_data_by_id):
+        """Replace rows of edges {edge id: meta_data}"""
+        EdgeMetaIndex.delete(session, list(meta_data_by_id))
+        rows = []
+        for edge_id, meta_data in meta_data_by_id.iteritems():
+            rows.extend(EdgeMetaIndex.get_rows(edge_id, meta_data))
+        if rows:
+            session.execute(EdgeMetaIndex.__table__.insert(), rows, mapper=EdgeMetaIndex)
+
+    @staticmethod
+    def get_filter_clause(meta_filter):
+        """Clause matching edges whose meta_data has all key/values of meta_filter"""
+        table = EdgeMetaIndex.__table__
+        clauses = []
+        for key, value in meta_filter.iteritems():
+            if key not in Edge.indexed_meta_keys:
+                raise ValueError(u'meta_data key "{0}" is not indexed, see Edge.indexed_meta_keys'.format(key))
+            encoded = encode_meta_value(value)
+            if encoded is None:
+                raise ValueError(u'meta_data value for "{0}" is not indexable'.format(key))
+            clauses.append(Edge.id.in_(select([table.c.edge_id]).where(and_(table.c.key == key, table.c.value == encoded))))
+        return and_(*clauses)
+
+    @staticmethod
+    def rebuild(session):
+        table = EdgeMetaIndex.__table__
+        edges = Edge.__table__
+        session.execute(table.delete(), mapper=EdgeMetaIndex)
+        rows = []
+        for edge_id, meta_data in session.execute(select([edges.c.id, edges.c.meta_data]).where(edges.c.meta_data != None), mapper=Edge):
+            rows.extend(EdgeMetaIndex.get_rows(edge_id, meta_data))
+            if len(rows) >= Edge.frontier_chunk_size:
+                session.execute(table.insert(), rows, mapper=EdgeMetaIndex)
+                rows = []
+        if rows:
+            session.execute(table.insert(), rows, mapper=EdgeMetaIndex)
+
+    @staticmethod
+    def after_flush(session, flush_context):
+        if not Edge.indexed_meta_keys:
+            return
+        EdgeMetaIndex.delete(session, [obj.id for obj in session.deleted if isinstance(obj, Edge)])
+        meta_data_by_id = {}
+        for obj in session.new:
+            if isinstance(obj, Edge):
+                meta_data_by_id[obj.id] = obj.meta_data
+        for obj in session.dirty:
+            if isinstance(obj, Edge) and inspect(obj).attrs._meta_data.history.has_changes():
+                meta_data_by_id[obj.id] = obj.meta_data
+        EdgeMetaIndex.sync(session, meta_data_by_id)
+
+
+class NodeMetaIndex(Base):
+    """Side table of node dict values for DictProperty(..., indexed=True),
+    kept in sync on flush. Query with DictProperty.get_filter_clause(value)."""
+    __tablename__ = 'node_meta_index'
+    __table_args__ = (Index('ix_node_meta_index_lookup', 'dict_name', 'key', 'value', 'node_uuid'), )
+    node_uuid = Column(Unicode(36), primary_key=True)
+    dict_name = Column(Unicode(100), primary_key=True)
+    key = Column(Unicode(100), primary_key=True)
+    value = Column(Unicode(META_VALUE_LENGTH))
+
+    _listening = False
+
+    @staticmethod
+    def listen():
+        # the flush hook is only added once a DictProperty is indexed
+        if not NodeMetaIndex._listening:
+            NodeMetaIndex._listening = True
+            event.listen(Session, 'after_flush', NodeMetaIndex.after_flush)
+
+    @staticmethod
+    def get_rows(node):
+        rows = []
+        for prop in get_indexed_dict_properties(node.__class__):
+            item = getattr(node, prop.dict_name, None)
+            if item and prop.key in item:
+                value = encode_meta_value(item[prop.key])
+                if value is not None:
+                    rows.append({'node_uuid': node.uuid, 'dict_name': prop.dict_name, 'key': prop.key, 'value': value})
+        return rows
+
+    @staticmethod
+    def delete(session, node_uuids):
+        table = NodeMetaIndex.__table__
+        for i in xrange(0, len(node_uuids), Edge.frontier_chunk_size):
+            chunk = node_uuids[i:i + Edge.frontier_chunk_size]
+            session.execute(table.delete().where(table.c.node_uuid.in_(chunk)), mapper=NodeMetaIndex)
+
+    @staticmethod
+    def sync(session, nodes):
+        NodeMetaIndex.delete(session, [node.uuid for node in nodes])
+        rows = []
+        for node in nodes:
+            rows.extend(NodeMetaIndex.get_rows(node))
+        if rows:
+            session.execute(NodeMetaIndex.__table__.insert(), rows, mapper=NodeMetaIndex)
+
+    @staticmethod
+    def rebuild(session):
+        session.execute(NodeMetaIndex.__table__.delete(), mapper=NodeMetaIndex)
+        node_cls = AbstractNode.get_node_cls()
+        nodes = []
+        for node in session.query(node_cls).yield_per(Edge.frontier_chunk_size):
+            if get_indexed_dict_properties(node.__class__):
+                nodes.append(node)
+            if len(nodes) >= Edge.frontier_chunk_size:
+                NodeMetaIndex.sync(session, nodes)
+                nodes = []
+        if nodes:
+            NodeMetaIndex.sync(session, nodes)
+
+    @staticmethod
+    def after_flush(session, flush_context):
+        deleted = [obj.uuid for obj in session.deleted
+                   if isinstance(obj, AbstractNode) and get_indexed_dict_properties(obj.__class__)]
+        NodeMetaIndex.delete(session, deleted)
+        nodes = [obj for obj in session.new if isinstance(obj, AbstractNode) and get_indexed_dict_properties(obj.__class__)]
+        nodes.extend(obj for obj in session.dirty if isinstance(obj, AbstractNode) and
+                     get_indexed_dict_properties(obj.__class__) and session.is_modified(obj))
+        if nodes:
+            NodeMetaIndex.sync(session, nodes)
+
+
+event.listen(Session, 'after_flush', EdgeMetaIndex.after_flush)
+
+add_public_properties(Edge)
 
 
 class AbstractNode(Base):
@@ -228,24 +905,6 @@ class AbstractNode(Base):
     def __unicode__(self):
         return '.uuid {0}'.format(self.uuid)
 
-    # def __getattribute__(self, attr):
-    #     if not (attr == '__dict__' or attr == '__class__'):
-    #         print "Getting ", attr , "on", self, attr in self.__class__.__dict__
-    #     return super(AbstractNode, self).__getattribute__(attr)
-
-    def __getattr__(self, attr):
-        attr = '_{0}'.format(attr)
-        if attr in self.__class__.__dict__:
-            return object.__getattribute__(self, attr)
-        else:
-            raise AttributeError
-
-    def __setattr__(self, attr, value):
-        if attr in self.__class__.__dict__ or attr == '_sa_instance_state':
-            object.__setattr__(self, attr, value)
-        else:
-            object.__setattr__(self, '_{0}'.format(attr), value)
-
     @property
     def classname(self):
         return self.__class__.__name__
@@ -262,44 +921,121 @@ class AbstractNode(Base):
     def session(self):
         return object_session(self)
 
-    def _get_children(self, discriminators=None, group=None, relation_type=None, order_by=None):
-        return self._get_related_node_query(None, Edge.CHILD, discriminators, group, relation_type, order_by).all()
+    def _get_children(self, discriminators=None, group=None, relation_type=None, order_by=None, meta_filter=None):
+        return self._get_related_node_query(None, Edge.CHILD, discriminators, group, relation_type, order_by, meta_filter).all()
 
     def _set_children(self, children=[], discriminators=None, group=None, relation_type=None, metadata=[]):
         Edge.update_child_edges(self, children, discriminators=discriminators, group=group, relation_type=relation_type, metadata=metadata)
 
-    def _get_parents(self, discriminators=None, group=None, relation_type=None, order_by=None):
-        return self._get_related_node_query(None, Edge.PARENT, discriminators, group, relation_type, order_by).all()
+    def _get_parents(self, discriminators=None, group=None, relation_type=None, order_by=None, meta_filter=None):
+        return self._get_related_node_query(None, Edge.PARENT, discriminators, group, relation_type, order_by, meta_filter).all()
 
     def _set_parents(self, parents=[], discriminators=None, group=None, relation_type=None, metadata=[]):
         Edge.update_parent_edges(self, parents, discriminators=discriminators, group=group, relation_type=relation_type, metadata=metadata)
 
-    def _get_child(self, discriminators=None, group=None, relation_type=False, order_by=None):
-        return self._get_related_node_query(None, Edge.CHILD, discriminators, group, relation_type, order_by).first()
+    def _get_child(self, discriminators=None, group=None, relation_type=False, order_by=None, meta_filter=None):
+        return self._get_related_node_query(None, Edge.CHILD, discriminators, group, relation_type, order_by, meta_filter).first()
+
+    def _get_parent(self, discriminators=None, group=None, relation_type=False, order_by=None, meta_filter=None):
+        return self._get_related_node_query(None, Edge.PARENT, discriminators, group, relation_type, order_by, meta_filter).first()
+
+    def _get_child_edges(self, discriminators=None, group=None, relation_type=None, order_by=None, meta_filter=None):
+        return self._get_related_node_query(Edge, Edge.CHILD, discriminators, group, relation_type, order_by, meta_filter).all()
+
+    def _get_parent_edges(self, discriminators=None, group=None, relation_type=None, order_by=None, meta_filter=None):
+        return self._get_related_node_query(Edge, Edge.PARENT, discriminators, group, relation_type, order_by, meta_filter).all()
+
+    def _get_child_edge(self, discriminators=None, group=None, relation_type=False, order_by=None, meta_filter=None):
+        return self._get_related_node_query(Edge, Edge.CHILD, discriminators, group, relation_type, order_by, meta_filter).first()
 
-    def _get_parent(self, discriminators=None, group=None, relation_type=False, order_by=None):
-        return self._get_related_node_query(None, Edge.PARENT, discriminators, group, relation_type, order_by).first()
+    def _get_parent_edge(self, discriminators=None, group=None, relation_type=False, order_by=None, meta_filter=None):
+        return self._get_related_node_query(Edge, Edge.PARENT, discriminators, group, relation_type, order_by, meta_filter).first()
 
-    def _get_child_edges(self, discriminators=None, group=None, relation_type=None, order_by=None):
-        return self._get_related_node_query(Edge, Edge.CHILD, discriminators, group, relation_type, order_by).all()
+    def get_descendants(self, discriminators=None, group=None, relation_type=None, max_depth=None, order_by=None):
+        """Return list of (node, depth) for all nodes below self, depth 1 being children.
+        discriminators filter returned nodes, group/relation_type filter traversed edges (False for any)."""
+        return list(self.iter_descendants(discriminators, group, relation_type, max_depth, order_by, chunk_size=None))
 
-    def _get_parent_edges(self, discriminators=None, group=None, relation_type=None, order_by=None):
-        return self._get_related_node_query(Edge, Edge.PARENT, discriminators, group, relation_type, order_by).all()
+    def get_ancestors(self, discriminators=None, group=None, relation_type=None, max_depth=None, order_by=None):
+        """Return list of (node, depth) for all nodes above self, depth 1 being parents."""
+        return list(self.iter_ancestors(discriminators, group, relation_type, max_depth, order_by, chunk_size=None))
 
-    def _get_child_edge(self, discriminators=None, group=None, relation_type=False, order_by=None):
-        return self._get_related_node_query(Edge, Edge.CHILD, discriminators, group, relation_type, order_by).first()
+    def iter_descendants(self, discriminators=None, group=None, relation_type=None, max_depth=None, order_by=None, chunk_size=1000):
+        """Generator variant of get_descendants, rows are fetched chunk_size at a time."""
+        return self._iter_traversal(Edge.CHILD, discriminators, group, relation_type, max_depth, order_by, chunk_size)
 
-    def _get_parent_edge(self, discriminators=None, group=None, relation_type=False, order_by=None):
-        return self._get_related_node_query(Edge, Edge.PARENT, discriminators, group, relation_type, order_by).first()
+    def iter_ancestors(self, discriminators=None, group=None, relation_type=None, max_depth=None, order_by=None, chunk_size=1000):
+        """Generator variant of get_ancestors, rows are fetched chunk_size at a time."""
+        return self._iter_traversal(Edge.PARENT, discriminators, group, relation_type, max_depth, order_by, chunk_size)
 
-    def _get_related_node_query(self, query_cls, relation=Edge.CHILD, discriminators=None, group=None, relation_type=None, order_by=None):
+    def get_descendant_uuids(self, group=None, relation_type=None, max_depth=None):
+        """Set of uuids of all nodes below self, without loading them"""
+        return Edge.get_reachable_uuids(self.session, self.uuid, Edge.CHILD, group, relation_type, max_depth)
+
+    def get_ancestor_uuids(self, group=None, relation_type=None, max_depth=None):
+        """Set of uuids of all nodes above self, without loading them"""
+        return Edge.get_reachable_uuids(self.session, self.uuid, Edge.PARENT, group, relation_type, max_depth)
+
+    def is_descendant_of(self, node, max_depth=None):
+        """True if self is somewhere below node, following edges of any group"""
+        return node.uuid != self.uuid and Edge.is_reachable(self.session, node.uuid, self.uuid, max_depth=max_depth)
+
+    def is_ancestor_of(self, node, max_depth=None):
+        """True if self is somewhere above node, following edges of any group"""
+        return node.is_descendant_of(self, max_depth=max_depth)
+
+    def _iter_traversal(self, relation, discriminators=None, group=None, relation_type=None, max_depth=None, order_by=None, chunk_size=1000):
+        if self._use_closure_table(group, relation_type) or Edge.supports_recursive_cte(self.session):
+            query = self._get_traversal_query(relation, discriminators, group, relation_type, max_depth, order_by)
+            if chunk_size:
+                query = query.yield_per(chunk_size)
+            for node, depth in query:
+                yield node, depth
+        else:
+            # one query per frontier, nodes are loaded level by level
+            node_cls = AbstractNode.get_node_cls()
+            for level in Edge.walk(self.session, self.uuid, relation, group, relation_type, max_depth):
+                depths = dict(level)
+                uuids = [uuid_string for uuid_string, depth in level]
+                for i in xrange(0, len(uuids), Edge.frontier_chunk_size):
+                    query = self.session.query(node_cls).filter(node_cls.uuid.in_(uuids[i:i + Edge.frontier_chunk_size]))
+                    if discriminators:
+                        query = query.filter(node_cls.discriminator.in_(discriminators))
+                    if order_by is not None:
+                        query = query.order_by(*(order_by if isinstance(order_by, list) else [order_by]))
+                    for node in query:
+                        yield node, depths[node.uuid]
+
+    def _get_traversal_query(self, relation=Edge.CHILD, discriminators=None, group=None, relation_type=None, max_depth=None, order_by=None):
+        """Query of (node, depth) over the closure table or a recursive CTE, ordered by depth"""
+        node_cls = AbstractNode.get_node_cls()
+        if self._use_closure_table(group, relation_type):
+            depths = EdgeClosure.get_depths_select(self.uuid, relation, max_depth).alias('depths')
+        else:
+            traversal = Edge.get_traversal_cte(self.uuid, relation, group, relation_type, max_depth)
+            # shortest depth per node
+            depths = select([traversal.c.uuid, func.min(traversal.c.depth).label('depth')]).group_by(traversal.c.uuid).alias('depths')
+        query = self.session.query(node_cls, depths.c.depth).join(depths, node_cls.uuid == depths.c.uuid)
+        if discriminators:
+            query = query.filter(node_cls.discriminator.in_(discriminators))
+        query = query.order_by(depths.c.depth)
+        if order_by is not None:
+            query = query.order_by(*(order_by if isinstance(order_by, list) else [order_by]))
+        return query
+
+    @staticmethod
+    def _use_closure_table(group, relation_type):
+        # closure rows cover edges of every group and relation type
+        return Edge.use_closure_table and group is False and relation_type is False
+
+    def _get_related_node_query(self, query_cls, relation=Edge.CHILD, discriminators=None, group=None, relation_type=None, order_by=None, meta_filter=None):
         node_cls = AbstractNode.get_node_cls()
         if query_cls == Edge:
             query = self.session.query(Edge).select_from(node_cls)
         else:
             query = self.session.query(node_cls)
 
-        clauses = self._get_related_node_query_clauses(relation, discriminators, group, relation_type)
+        clauses = self._get_related_node_query_clauses(relation, discriminators, group, relation_type, meta_filter)
         node_edge = (Edge, node_cls.uuid == Edge.right_uuid) if relation == Edge.CHILD else (Edge, node_cls.uuid == Edge.left_uuid)
 
         query = query.join(node_edge).filter(and_(*clauses))
@@ -310,7 +1046,7 @@ class AbstractNode(Base):
                 query = query.order_by(order_by)
         return query
 
-    def _get_related_node_query_clauses(self, relation=Edge.CHILD, discriminators=None, group=None, relation_type=None):
+    def _get_related_node_query_clauses(self, relation=Edge.CHILD, discriminators=None, group=None, relation_type=None, meta_filter=None):
         """docstring for _get_related_node_query_clauses"""
         clauses = []
         if relation == Edge.CHILD:
@@ -327,10 +1063,21 @@ class AbstractNode(Base):
         if relation_type is not False:
             clauses.append(Edge._relation_type == relation_type)
 
+        if meta_filter:
+            clauses.append(EdgeMetaIndex.get_filter_clause(meta_filter))
+
         return clauses
 
+    @classmethod
+    def _on_instrument_class(cls, mapper, node_cls):
+        add_public_properties(node_cls)
+
     @classmethod
     def get_node_cls(cls):
+        return get_class_cached(('node_cls', cls), cls._get_node_cls)
+
+    @classmethod
+    def _get_node_cls(cls):
         subclasses = cls.__subclasses__()
         if len(subclasses) == 0:
             raise Exception('No Node class defined, extension of AbstractNode required.')
@@ -350,19 +1097,27 @@ class AbstractNode(Base):
     def get_singular(cls):
         return cls.get_polymorphic_identity()
 
+event.listen(AbstractNode, 'instrument_class', AbstractNode._on_instrument_class, propagate=True)
+
 # ===============
 # = Descriptors =
 # ===============
 
 class DictProperty(object):
 
-    def __init__(self, key, dict_name=None, default_value=None):
+    def __init__(self, key, dict_name=None, default_value=None, indexed=False):
         super(DictProperty, self).__init__()
         self.dict_name = dict_name
         self.key = key
         self.default_value = default_value
+        # values kept in NodeMetaIndex
+        self.indexed = indexed
+        if indexed:
+            NodeMetaIndex.listen()
 
     def __get__(self, instance, cls):
+        if instance is None:
+            return self
         item = self._get_dict(instance)
         return item.get(self.key, self.default_value)
 
@@ -385,6 +1140,31 @@ class DictProperty(object):
 
         return item
 
+    def get_filter_clause(self, value):
+        """Clause matching nodes where this dict key equals value, e.g.
+        session.query(Node).filter(Article.color.get_filter_clause(u'red'))"""
+        if not self.indexed:
+            raise ValueError(u'DictProperty "{0}" is not indexed'.format(self.key))
+        encoded = encode_meta_value(value)
+        if encoded is None:
+            raise ValueError(u'Value for "{0}" is not indexable'.format(self.key))
+        table = NodeMetaIndex.__table__
+        return AbstractNode.get_node_cls().uuid.in_(select([table.c.node_uuid]).where(
+            and_(table.c.dict_name == self.dict_name, table.c.key == self.key, table.c.value == encoded)))
+
+def get_indexed_dict_properties(cls):
+    def find():
+        props = []
+        for klass in cls.__mro__:
+            for value in klass.__dict__.values():
+                if isinstance(value, DictProperty) and value.indexed and value not in props:
+                    props.append(value)
+        return tuple(props)
+    return get_class_cached(('indexed_dict_properties', cls), find)
+
+# instance __dict__ key of {RelatedNodes: [related nodes]}, see prefetch_related
+PREFETCHED_KEY = '_prefetched_related'
+
 class RelatedNodes(object):
 
     CHILDREN = u'children'
@@ -400,23 +1180,88 @@ class RelatedNodes(object):
         self.group = kws.get('group', None)
         self.relation_type = kws.get('relation_type', None)
         self.order_by = kws.get('order_by', None)
+        # {meta_data key: value} on edges, see EdgeMetaIndex
+        self.meta_filter = kws.get('meta_filter', None)
 
     def __get__(self, instance, cls):
-        return getattr(instance, '_get_{0}'.format(self.direction))(discriminators=self.discriminators, group=self.group, relation_type=self.relation_type, order_by=self.order_by)
+        if instance is None:
+            return self
+        prefetched = instance.__dict__.get(PREFETCHED_KEY)
+        if prefetched and self in prefetched:
+            return list(prefetched[self])
+        cache = RelatedNodesCache.get_cache(instance.session)
+        if cache is not None:
+            key = self.get_cache_key(instance)
+            nodes = cache.get(key)
+            if nodes is None:
+                nodes = self._get(instance)
+                cache.set(key, nodes)
+            return list(nodes)
+        return self._get(instance)
+
+    def _get(self, instance):
+        return getattr(instance, '_get_{0}'.format(self.direction))(discriminators=self.discriminators, group=self.group, relation_type=self.relation_type,
+                                                                  order_by=self.order_by, meta_filter=self.meta_filter)
+
+    def get_cache_key(self, instance):
+        """(node uuid, direction, discriminators, group, relation_type, order_by, meta_filter)"""
+        discriminators = self.discriminators
+        order_by = self.order_by
+        if order_by is not None:
+            order_by = tuple(str(clause) for clause in (order_by if isinstance(order_by, list) else [order_by]))
+        meta_filter = tuple(sorted(self.meta_filter.items())) if self.meta_filter else None
+        return (instance.uuid, self.direction, tuple(discriminators) if discriminators else None, self.group, self.relation_type, order_by, meta_filter)
 
     def __set__(self, instance, value):
         discriminators = self.discriminators
         if discriminators:
+            discriminator_set = self.discriminator_set
             for node in value:
-                if node.discriminator not in discriminators:
+                if node.discriminator not in discriminator_set:
                     raise ValueError('One of the {0} passed as argument is of wrong type'.format(self.direction))
 
+        instance.__dict__.get(PREFETCHED_KEY, {}).pop(self, None)
         getattr(instance, '_set_{0}'.format(self.direction))(value, discriminators=discriminators, group=self.group, relation_type=self.relation_type)
 
+    def prefetch(self, nodes):
+        """Load related nodes for all nodes in one query per chunk, grouped by edge
+        left_uuid/right_uuid, and store them for __get__ on each node"""
+        if not nodes:
+            return
+        node_cls = AbstractNode.get_node_cls()
+        if self.direction == RelatedNodes.CHILDREN:
+            near, far = Edge.left_uuid, Edge.right_uuid
+        else:
+            near, far = Edge.right_uuid, Edge.left_uuid
+        clauses = Edge._get_edge_filter_clauses(self.group, self.relation_type)
+        discriminators = self.discriminators
+        if discriminators:
+            clauses.append(node_cls.discriminator.in_(discriminators))
+        if self.meta_filter:
+            clauses.append(EdgeMetaIndex.get_filter_clause(self.meta_filter))
+        related = dict((node.uuid, []) for node in nodes)
+        uuids = list(related)
+        session = nodes[0].session
+        # see clear_prefetched_after_flush
+        session.info[PREFETCHED_KEY] = True
+        for i in xrange(0, len(uuids), Edge.frontier_chunk_size):
+            chunk = uuids[i:i + Edge.frontier_chunk_size]
+            query = session.query(node_cls, near).join(Edge, node_cls.uuid == far).filter(and_(near.in_(chunk), *clauses))
+            if self.order_by is not None:
+                query = query.order_by(*(self.order_by if isinstance(self.order_by, list) else [self.order_by]))
+            for related_node, uuid_string in query:
+                related[uuid_string].append(related_node)
+        for node in nodes:
+            node.__dict__.setdefault(PREFETCHED_KEY, {})[self] = related[node.uuid]
+
     @property
     def discriminators(self):
         return get_discriminators(*self.classes, include_subclasses=self.include_subclasses)
 
+    @property
+    def discriminator_set(self):
+        return get_discriminator_set(*self.classes, include_subclasses=self.include_subclasses)
+
 class Children(RelatedNodes):
 
     def __init__(self, *args, **kws):
@@ -427,6 +1272,133 @@ class Parents(RelatedNodes):
     def __init__(self, *args, **kws):
         super(Parents, self).__init__(RelatedNodes.PARENTS, *args, **kws)
 
+class RelatedNodesCache(object):
+    """Opt-in, per session cache of RelatedNodes.__get__ results, see enable().
+    Entries of a node are dropped when a flush inserts, deletes or updates an
+    edge to or from it, everything is dropped on rollback."""
+
+    INFO_KEY = 'node.related_nodes_cache'
+
+    def __init__(self):
+        super(RelatedNodesCache, self).__init__()
+        # {node uuid: {cache key: [nodes]}}
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    @staticmethod
+    def enable(session):
+        cache = session.info.get(RelatedNodesCache.INFO_KEY)
+        if cache is None:
+            cache = session.info[RelatedNodesCache.INFO_KEY] = RelatedNodesCache()
+        return cache
+
+    @staticmethod
+    def disable(session):
+        return session.info.pop(RelatedNodesCache.INFO_KEY, None)
+
+    @staticmethod
+    def get_cache(session):
+        if session is None:
+            return None
+        return session.info.get(RelatedNodesCache.INFO_KEY)
+
+    def get(self, key):
+        nodes = self.entries.get(key[0], {}).get(key)
+        if nodes is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return nodes
+
+    def set(self, key, nodes):
+        self.entries.setdefault(key[0], {})[key] = nodes
+
+    def invalidate(self, uuids):
+        for uuid_string in uuids:
+            if self.entries.pop(uuid_string, None) is not None:
+                self.invalidations += 1
+
+    def clear(self):
+        self.entries.clear()
+
+    def get_stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'invalidations': self.invalidations,
+            'size': sum(len(entries) for entries in self.entries.itervalues())
+        }
+
+    @staticmethod
+    def after_flush(session, flush_context):
+        cache = RelatedNodesCache.get_cache(session)
+        if cache is None:
+            return
+        removed, added, updated = Edge.get_flushed_edges(session)
+        cache.invalidate([uuid_string for pair in removed + added + updated for uuid_string in pair])
+
+    @staticmethod
+    def after_soft_rollback(session, previous_transaction):
+        cache = RelatedNodesCache.get_cache(session)
+        if cache is not None:
+            cache.clear()
+
+
+event.listen(Session, 'after_flush', RelatedNodesCache.after_flush)
+event.listen(Session, 'after_soft_rollback', RelatedNodesCache.after_soft_rollback)
+
+
+def prefetch_related(nodes, *attrs):
+    """Prefetch RelatedNodes descriptors named attrs (e.g. 'children') for a list of nodes,
+    one query per descriptor instead of one per node and descriptor.
+
+    prefetch_related(articles, 'children', 'parents')
+
+    Results are served until set through the same descriptor, the node's edges are
+    flushed or changed by Edge.update_related_edges or remove_all_edges, the node
+    is expired or refreshed (e.g. on commit), or clear_prefetched(node).
+    """
+    for attr in attrs:
+        by_descriptor = {}
+        for node in nodes:
+            descriptor = getattr(node.__class__, attr)
+            if not isinstance(descriptor, RelatedNodes):
+                raise AttributeError(u'"{0}" on {1} is not a RelatedNodes descriptor'.format(attr, node.classname))
+            by_descriptor.setdefault(descriptor, []).append(node)
+        for descriptor, descriptor_nodes in by_descriptor.iteritems():
+            descriptor.prefetch(descriptor_nodes)
+
+def clear_prefetched(node):
+    node.__dict__.pop(PREFETCHED_KEY, None)
+
+def clear_prefetched_uuids(session, uuids):
+    """clear_prefetched on the nodes of uuids loaded in session"""
+    node_cls = AbstractNode.get_node_cls()
+    for uuid_string in set(uuids):
+        node = session.identity_map.get(identity_key(node_cls, uuid_string))
+        if node is not None:
+            clear_prefetched(node)
+
+def clear_prefetched_after_flush(session, flush_context):
+    """Session 'after_flush' hook, clears prefetched lists of the endpoints of
+    flushed edges, in sessions that prefetched"""
+    if not session.info.get(PREFETCHED_KEY):
+        return
+    removed, added, updated = Edge.get_flushed_edges(session)
+    clear_prefetched_uuids(session, [uuid_string for pair in removed + added + updated for uuid_string in pair])
+
+def _on_expire_or_refresh(node, *args):
+    # None once a commit expires a garbage collected instance
+    if node is not None:
+        clear_prefetched(node)
+
+# prefetched lists end with the loaded state
+event.listen(AbstractNode, 'expire', _on_expire_or_refresh, propagate=True)
+event.listen(AbstractNode, 'refresh', _on_expire_or_refresh, propagate=True)
+event.listen(Session, 'after_flush', clear_prefetched_after_flush)
+
 # AbstractNode.children = RelatedNodes('children', AbstractNode)
 # AbstractNode.parents = RelatedNodes('parents', AbstractNode)
 # AbstractNode.children = Children(AbstractNode)
@@ -0,0 +1,298 @@
+# -*- coding: utf-8 -*-
+"""Opt-in SQL profiling per session or request, with N+1 detection.
+
+profiler = QueryProfiler(repeat_threshold=10)
+profiler.attach(session)
+...
+profiler.get_summary()
+
+Statements are grouped by shape, the SQL text with IN lists collapsed, and
+attributed to the AbstractNode accessor or RelatedNodes descriptor they ran
+under (e.g. 'Node.children'), else to the first application frame. A shape
+running more than repeat_threshold times emits a RepeatedQueryWarning.
+"""
+import os
+import re
+import sys
+import time
+import warnings
+
+import sqlalchemy
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+
+from node.model import RelatedNodes
+from node.util import get_class_cached
+
+NODE_DIR = os.path.dirname(os.path.abspath(__file__))
+SQLALCHEMY_DIR = os.path.dirname(os.path.abspath(sqlalchemy.__file__))
+# node modules that run statements for the caller, not accessors
+SKIPPED_NODE_MODULES = ('profiling', 'middleware', 'db_util')
+
+PLACEHOLDER_LIST_RE = re.compile(r'\(\s*(?:\?|%s|%\(\w+\)s|:\w+)(?:\s*,\s*(?:\?|%s|%\(\w+\)s|:\w+))+\s*\)')
+WHITESPACE_RE = re.compile(r'\s+')
+
+
+class RepeatedQueryWarning(UserWarning):
+    pass
+
+
+class ShapeStats(object):
+
+    def __init__(self, shape):
+        super(ShapeStats, self).__init__()
+        self.shape = shape
+        self.count = 0
+        self.time = 0.0
+        self.rows = 0
+        # {source label: count}
+        self.sources = {}
+
+    def as_dict(self):
+        return {
+            'shape': self.shape,
+            'count': self.count,
+            'time': self.time,
+            'rows': self.rows,
+            'sources': dict(self.sources)
+        }
+
+
+class CountingCursor(object):
+    """DBAPI cursor proxy adding fetched rows to a ShapeStats"""
+
+    def __init__(self, cursor, profiler, shape_stats):
+        self._cursor = cursor
+        self._profiler = profiler
+        self._shape_stats = shape_stats
+
+    def _count(self, rows):
+        self._shape_stats.rows += rows
+        self._profiler.rows += rows
+
+    def fetchone(self):
+        row = self._cursor.fetchone()
+        if row is not None:
+            self._count(1)
+        return row
+
+    def fetchmany(self, *args, **kws):
+        rows = self._cursor.fetchmany(*args, **kws)
+        self._count(len(rows))
+        return rows
+
+    def fetchall(self):
+        rows = self._cursor.fetchall()
+        self._count(len(rows))
+        return rows
+
+    def __iter__(self):
+        for row in self._cursor:
+            self._count(1)
+            yield row
+
+    def __getattr__(self, attr):
+        return getattr(self._cursor, attr)
+
+
+class QueryProfiler(object):
+    """Records statements of the sessions it is attached to. count_rows wraps
+    cursors to count fetched rows. on_repeat, if given, is called with the
+    ShapeStats instead of warning."""
+
+    INFO_KEY = 'node.query_profiler'
+    _listening = False
+
+    def __init__(self, repeat_threshold=10, count_rows=True, on_repeat=None):
+        super(QueryProfiler, self).__init__()
+        self.repeat_threshold = repeat_threshold
+        self.count_rows = count_rows
+        self.on_repeat = on_repeat
+        self.statements = 0
+        self.rows = 0
+        self.times = []
+        # {shape: ShapeStats}
+        self.shapes = {}
+        self.repeated = []
+        # connection.info dicts tagged with this profiler
+        self._connection_infos = []
+
+    @staticmethod
+    def _listen():
+        # engine wide listeners are only added once a profiler is used
+        if not QueryProfiler._listening:
+            QueryProfiler._listening = True
+            event.listen(Engine, 'before_cursor_execute', QueryProfiler._before_cursor_execute)
+            event.listen(Engine, 'after_cursor_execute', QueryProfiler._after_cursor_execute)
+            event.listen(Session, 'after_begin', QueryProfiler._after_begin)
+            event.listen(Session, 'after_transaction_end', QueryProfiler._after_transaction_end)
+
+    def attach(self, session):
+        QueryProfiler._listen()
+        session.info[QueryProfiler.INFO_KEY] = self
+        # connections already in the session transaction
+        transaction = session.transaction
+        if transaction is not None:
+            for connection in set(transaction._connections[key][0] for key in transaction._connections):
+                self._tag(connection)
+        return self
+
+    def detach(self, session):
+        session.info.pop(QueryProfiler.INFO_KEY, None)
+        self._untag()
+
+    @staticmethod
+    def get_profiler(session):
+        return session.info.get(QueryProfiler.INFO_KEY)
+
+    def _tag(self, connection):
+        info = connection.info
+        info[QueryProfiler.INFO_KEY] = self
+        self._connection_infos.append(info)
+
+    def _untag(self):
+        for info in self._connection_infos:
+            if info.get(QueryProfiler.INFO_KEY) is self:
+                del info[QueryProfiler.INFO_KEY]
+        self._connection_infos = []
+
+    @staticmethod
+    def _after_begin(session, transaction, connection):
+        profiler = QueryProfiler.get_profiler(session)
+        if profiler is not None:
+            profiler._tag(connection)
+
+    @staticmethod
+    def _after_transaction_end(session, transaction):
+        # pooled connections go to other sessions next
+        profiler = QueryProfiler.get_profiler(session)
+        if profiler is not None and transaction.parent is None:
+            profiler._untag()
+
+    @staticmethod
+    def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if QueryProfiler.INFO_KEY in conn.info:
+            conn.info['node.query_started_at'] = time.time()
+
+    @staticmethod
+    def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        profiler = conn.info.get(QueryProfiler.INFO_KEY)
+        started_at = conn.info.pop('node.query_started_at', None)
+        if profiler is None or started_at is None:
+            return
+        shape_stats = profiler.record(statement, time.time() - started_at)
+        if profiler.count_rows and context is not None and cursor.description is not None:
+            # the result proxy is built on context.cursor after this event
+            context.cursor = CountingCursor(cursor, profiler, shape_stats)
+
+    def record(self, statement, seconds, source=None):
+        shape = get_statement_shape(statement)
+        shape_stats = self.shapes.get(shape)
+        if shape_stats is None:
+            shape_stats = self.shapes[shape] = ShapeStats(shape)
+        source = source or get_statement_source()
+        self.statements += 1
+        self.times.append(seconds)
+        shape_stats.count += 1
+        shape_stats.time += seconds
+        shape_stats.sources[source] = shape_stats.sources.get(source, 0) + 1
+        if shape_stats.count == self.repeat_threshold + 1:
+            self.repeated.append(shape_stats)
+            if self.on_repeat:
+                self.on_repeat(shape_stats)
+            else:
+                warn_repeated(u'Statement ran more than {0} times, from {1}: {2}'.format(
+                    self.repeat_threshold, ', '.join(sorted(shape_stats.sources)), shape))
+        return shape_stats
+
+    @property
+    def total_time(self):
+        return sum(self.times)
+
+    def get_percentile(self, percentile):
+        if not self.times:
+            return 0.0
+        times = sorted(self.times)
+        return times[min(len(times) - 1, int(round(percentile / 100.0 * (len(times) - 1))))]
+
+    def get_summary(self, top=10):
+        """Counts, timings and the top shapes by count"""
+        shapes = sorted(self.shapes.itervalues(), key=lambda shape_stats: (-shape_stats.count, -shape_stats.time))
+        return {
+            'statements': self.statements,
+            'rows': self.rows,
+            'total_time': self.total_time,
+            'p50': self.get_percentile(50),
+            'p90': self.get_percentile(90),
+            'p99': self.get_percentile(99),
+            'max': max(self.times) if self.times else 0.0,
+            'shapes': [shape_stats.as_dict() for shape_stats in shapes[:top]],
+            'repeated': [shape_stats.as_dict() for shape_stats in self.repeated]
+        }
+
+
+def get_statement_shape(statement):
+    """Statement text with whitespace normalized and placeholder lists collapsed"""
+    shape = WHITESPACE_RE.sub(' ', statement).strip()
+    return PLACEHOLDER_LIST_RE.sub('(...)', shape)
+
+
+def get_statement_source():
+    """Label of the outermost node accessor running the statement, e.g.
+    'Node.children' or 'Node.get_descendants', else 'file:line function'
+    of the first frame outside SQLAlchemy and node."""
+    label, frame = walk_frames(sys._getframe(1))
+    if label is None and frame is not None:
+        return '{0}:{1} {2}'.format(os.path.abspath(frame.f_code.co_filename), frame.f_lineno, frame.f_code.co_name)
+    return label
+
+
+def walk_frames(frame):
+    """(label of the outermost node accessor or None, first frame outside
+    SQLAlchemy and node or None)"""
+    label = None
+    while frame is not None:
+        filename = os.path.abspath(frame.f_code.co_filename)
+        if filename.startswith(SQLALCHEMY_DIR):
+            frame = frame.f_back
+            continue
+        if filename.startswith(NODE_DIR):
+            module = os.path.splitext(os.path.basename(filename))[0]
+            if module not in SKIPPED_NODE_MODULES:
+                label = get_frame_label(frame, module)
+            frame = frame.f_back
+            continue
+        break
+    return label, frame
+
+
+def warn_repeated(message):
+    """RepeatedQueryWarning reported at the application frame running the statement"""
+    label, frame = walk_frames(sys._getframe(1))
+    if frame is None:
+        warnings.warn(message, RepeatedQueryWarning)
+        return
+    warnings.warn_explicit(message, RepeatedQueryWarning, frame.f_code.co_filename, frame.f_lineno,
+                           module=frame.f_globals.get('__name__'), registry=frame.f_globals.setdefault('__warningregistry__', {}))
+
+
+def get_frame_label(frame, module):
+    obj = frame.f_locals.get('self')
+    instance = frame.f_locals.get('instance')
+    if isinstance(obj, RelatedNodes) and instance is not None:
+        return '{0}.{1}'.format(type(instance).__name__, get_descriptor_name(type(instance), obj))
+    if obj is not None:
+        return '{0}.{1}'.format(type(obj).__name__, frame.f_code.co_name)
+    return '{0}.{1}'.format(module, frame.f_code.co_name)
+
+
+def get_descriptor_name(cls, descriptor):
+    """Attribute name of a RelatedNodes descriptor on cls, its direction if not found"""
+    def find():
+        for klass in cls.__mro__:
+            for name, value in klass.__dict__.iteritems():
+                if value is descriptor:
+                    return name
+        return descriptor.direction
+    return get_class_cached(('descriptor_name', cls, descriptor), find)
@@ -1,13 +1,22 @@
 # -*- coding: utf-8 -*-
 from uuid import UUID
 import sys
+import json
 import simplejson
 import inspect
-from sqlalchemy import UnicodeText
-from sqlalchemy.orm import EXT_CONTINUE
+from decimal import Decimal
+from functools import partial
+from sqlalchemy import UnicodeText, event
+from sqlalchemy.orm import EXT_CONTINUE, Mapper
 from sqlalchemy.orm.interfaces import MapperExtension
 from sqlalchemy.types import TypeDecorator
 
+try:
+    from sqlalchemy.types import JSON
+except ImportError:
+    # SQLAlchemy < 1.1
+    JSON = None
+
 class ConstantMeta(type):
     """Collects unicode constants set on class"""
     def __init__(cls, class_name, bases, class_dict):
@@ -26,13 +35,36 @@ class ConstantMeta(type):
 #             if type(v) == unicode:
 #                 cls.values.append(v)
 
-def get_subclasses(cls):
+# Memoized class hierarchy lookups, {key: value}. Cleared whenever
+# a mapper is created or mappers are configured.
+_class_cache = {}
+
+def get_class_cached(key, factory):
+    try:
+        return _class_cache[key]
+    except KeyError:
+        value = _class_cache[key] = factory()
+        return value
+
+def clear_class_cache(*args):
+    _class_cache.clear()
+
+event.listen(Mapper, 'instrument_class', clear_class_cache)
+event.listen(Mapper, 'after_configured', clear_class_cache)
+
+def _get_subclasses(cls):
     subclasses = cls.__subclasses__()
     for d in list(subclasses):
-        subclasses.extend(get_subclasses(d))
-    return subclasses
+        subclasses.extend(_get_subclasses(d))
+    return tuple(subclasses)
+
+def get_subclasses(cls):
+    return list(get_class_cached(('subclasses', cls), lambda: _get_subclasses(cls)))
 
 def get_discriminator_map(cls):
+    return dict(get_class_cached(('discriminator_map', cls), lambda: _get_discriminator_map(cls)))
+
+def _get_discriminator_map(cls):
     obj = {}
     for c in get_subclasses(cls):
         obj[c.get_polymorphic_identity()] = c
@@ -41,15 +73,25 @@ def get_discriminator_map(cls):
 
 def get_discriminators(*args, **kws):
     include_subclasses = kws.get('include_subclasses', True)
+    items = get_class_cached(('discriminators', args, include_subclasses), lambda: _get_discriminators(args, include_subclasses))
+    if items:
+        return list(items)
+    return None
+
+def get_discriminator_set(*args, **kws):
+    """frozenset of get_discriminators(), for membership checks"""
+    include_subclasses = kws.get('include_subclasses', True)
+    return get_class_cached(('discriminator_set', args, include_subclasses),
+                            lambda: frozenset(get_discriminators(*args, include_subclasses=include_subclasses) or ()))
+
+def _get_discriminators(args, include_subclasses):
     items = []
     for cls in args:
         items.append(cls.get_polymorphic_identity())
         if include_subclasses:
             for subcls in get_subclasses(cls):
                 items.append(subcls.get_polymorphic_identity())
-    if len(items) > 0:
-        return items
-    return None
+    return tuple(items)
 
 InputMismatchError = TypeError("Inputs must be both unicode or both bytes")
 
@@ -139,18 +181,103 @@ class Callback(MapperExtension):
         return EXT_CONTINUE
 
 
+# ===============
+# = JSON codecs =
+# ===============
+
+class JSONCodec(object):
+    """dumps(value) -> unicode, loads(unicode) -> value"""
+
+    def __init__(self, name, dumps, loads):
+        super(JSONCodec, self).__init__()
+        self.name = name
+        self.dumps = dumps
+        self.loads = loads
+
+_json_codecs = {}
+_default_json_codec = [u'simplejson']
+
+def register_json_codec(name, dumps, loads):
+    _json_codecs[name] = JSONCodec(name, dumps, loads)
+    return _json_codecs[name]
+
+def get_json_codec(name=None):
+    """Registered codec by name, None for the default codec"""
+    name = name or _default_json_codec[0]
+    if name not in _json_codecs:
+        raise ValueError(u'Unknown JSON codec "{0}"'.format(name))
+    return _json_codecs[name]
+
+def set_default_json_codec(name):
+    _default_json_codec[0] = get_json_codec(name).name
+
+def simplejson_dumps(value):
+    return unicode(simplejson.dumps(value, use_decimal=True))
+
+def simplejson_loads(string):
+    return simplejson.loads(string, use_decimal=True)
+
+def json_dumps(value):
+    try:
+        return unicode(json.dumps(value, separators=(',', ':')))
+    except TypeError:
+        # Decimal
+        return simplejson_dumps(value)
+
+register_json_codec(u'simplejson', simplejson_dumps, simplejson_loads)
+register_json_codec(u'json', json_dumps, partial(json.loads, parse_float=Decimal))
+
+def get_json_engine_params():
+    """create_engine() params serializing native JSON columns with the default codec"""
+    if not JSONEncodedObj.use_native_json:
+        return {}
+    return {
+        'json_serializer': lambda value: get_json_codec().dumps(value),
+        'json_deserializer': lambda string: get_json_codec().loads(string)
+    }
+
+
 class JSONEncodedObj(TypeDecorator):
-    """Represents an immutable structure as a json-encoded string."""
+    """Represents an immutable structure as a json-encoded string.
+
+    codec: name of a registered JSON codec, None for the default codec.
+    native: store in the dialect's JSON type on MySQL, PostgreSQL and SQLite,
+    None follows JSONEncodedObj.use_native_json. Native columns are encoded by
+    the engine, see get_json_engine_params."""
     impl = UnicodeText
 
+    use_native_json = False
+    native_json_dialects = ('mysql', 'postgresql', 'sqlite')
+
+    def __init__(self, codec=None, native=None, *args, **kws):
+        super(JSONEncodedObj, self).__init__(*args, **kws)
+        self.codec = codec
+        self.native = native
+
+    def is_native(self, dialect):
+        native = self.native if self.native is not None else JSONEncodedObj.use_native_json
+        return bool(native) and JSON is not None and dialect.name in JSONEncodedObj.native_json_dialects
+
+    def load_dialect_impl(self, dialect):
+        if self.is_native(dialect):
+            return dialect.type_descriptor(JSON(none_as_null=True))
+        return dialect.type_descriptor(self.impl)
+
     def process_bind_param(self, value, dialect):
-        if value is not None:
-            value = unicode(simplejson.dumps(value, use_decimal=True))
+        if value is not None and not self.is_native(dialect):
+            value = get_json_codec(self.codec).dumps(value)
         return value
 
     def process_result_value(self, value, dialect):
-        if value is not None:
-            value = simplejson.loads(value, use_decimal=True)
+        if value is not None and not self.is_native(dialect):
+            value = self.loads(value)
+        return value
+
+    def loads(self, value):
+        """JSON text decoded with the column's codec, other values as they are,
+        e.g. native JSON already decoded by the driver"""
+        if isinstance(value, basestring):
+            value = get_json_codec(self.codec).loads(value)
         return value
 
 # list functions defined in module
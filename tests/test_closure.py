@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+import unittest
+
+from helpers import Node, new_session, build_tree
+from node.model import Edge, EdgeClosure
+
+
+class EdgeClosureTest(unittest.TestCase):
+    """edge_closure stays consistent with the edges table (EdgeClosure.check)
+    through every way edges change"""
+
+    def setUp(self):
+        Edge.use_closure_table = True
+        self.session = new_session()
+        self.root, self.leaves = build_tree(self.session, 3, 3)
+
+    def tearDown(self):
+        Edge.use_closure_table = False
+
+    def assertConsistent(self):
+        self.assertEqual(EdgeClosure.check(self.session), [])
+
+    def assertCycleRefused(self, func, *args):
+        with self.assertRaisesRegexp(Exception, 'Cirular reference'):
+            func(*args)
+
+    def test_create_tree(self):
+        self.assertConsistent()
+
+    def test_create_edge_diamond(self):
+        # two paths from root to the leaves under middle
+        middle = self.root.children[0].children[0]
+        self.session.add(Edge.create_edge(self.root.children[1], middle))
+        self.session.commit()
+        self.assertConsistent()
+
+    def test_update_child_edges(self):
+        parent = self.root.children[2]
+        old_children = parent.children
+        new_nodes = [Node(), Node()]
+        result = Edge.update_child_edges(parent, old_children + new_nodes)
+        self.assertEqual((len(result['added']), result['updated'], result['removed']), (2, [], []))
+        self.session.commit()
+        self.assertConsistent()
+
+        keep = [old_children[1], new_nodes[0]]
+        result = Edge.update_child_edges(parent, keep)
+        self.assertEqual(result['added'], [])
+        self.assertEqual(sorted(result['updated']), sorted(node.uuid for node in keep))
+        self.assertEqual(sorted(result['removed']), sorted([old_children[0].uuid, old_children[2].uuid, new_nodes[1].uuid]))
+        self.session.commit()
+        self.assertEqual([node.uuid for node in parent.children], [node.uuid for node in keep])
+        self.assertConsistent()
+
+    def test_update_parent_edges(self):
+        result = Edge.update_parent_edges(self.leaves[0], [self.root, self.root.children[2]])
+        self.assertTrue(result['added'])
+        self.session.commit()
+        self.assertConsistent()
+
+    def test_cycles_refused(self):
+        middle = self.root.children[0].children[0]
+        self.assertCycleRefused(Edge.update_child_edges, self.leaves[0], [self.root])
+        self.assertCycleRefused(Edge.update_parent_edges, self.root, [middle])
+        self.assertCycleRefused(Edge.update_child_edges, middle, [middle])
+        self.session.rollback()
+        self.assertConsistent()
+
+    def test_move_and_delete_edge(self):
+        edge = self.session.query(Edge).filter(Edge.right_uuid == self.leaves[1].uuid).first()
+        edge.child = self.leaves[6]
+        self.session.commit()
+        self.assertConsistent()
+        edge.right_uuid = self.leaves[9].uuid
+        self.session.commit()
+        self.assertConsistent()
+        self.session.delete(edge)
+        self.session.commit()
+        self.assertConsistent()
+
+    def test_remove_all_edges(self):
+        Edge.remove_all_edges(self.root.children[0])
+        self.session.commit()
+        self.assertConsistent()
+
+    def test_rollback(self):
+        Edge.update_child_edges(self.root, [Node(), Node()])
+        self.session.add(Edge.create_edge(self.leaves[-1], Node()))
+        self.session.flush()
+        self.session.rollback()
+        self.assertConsistent()
+
+    def test_rebuild(self):
+        EdgeClosure.rebuild(self.session)
+        self.session.commit()
+        self.assertConsistent()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+import shutil
+import tempfile
+import unittest
+
+import helpers  # noqa, puts the package on sys.path
+from whoosh import fields
+from whoosh.fields import UnknownFieldError
+
+from node.index import BatchWriter, get_index
+
+
+class BatchWriterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        schema = fields.Schema(uuid=fields.ID(stored=True, unique=True), count=fields.NUMERIC(stored=True))
+        self.ix = get_index(u'test', schema, self.path)
+        self.errors = []
+        self.writer = BatchWriter(self.ix, interval=60, on_error=self.errors.append)
+
+    def tearDown(self):
+        self.writer.close()
+        shutil.rmtree(self.path)
+
+    def get_uuids(self):
+        with self.ix.searcher() as searcher:
+            return sorted(stored['uuid'] for stored in searcher.all_stored_fields())
+
+    def test_unknown_field_raises_to_caller(self):
+        self.writer.add_document(uuid=u'a')
+        self.assertRaises(UnknownFieldError, self.writer.add_document, uuid=u'b', colour=u'red')
+        self.assertRaises(UnknownFieldError, self.writer.delete_by_term, 'colour', u'red')
+        self.writer.add_document(uuid=u'c')
+        self.assertEqual(self.writer.flush(), 2)
+        self.assertEqual(self.get_uuids(), [u'a', u'c'])
+
+    def test_rejected_operation_dropped(self):
+        self.writer.add_document(uuid=u'a', count=1)
+        self.writer.add_document(uuid=u'b', count=u'not a number')
+        self.writer.add_document(uuid=u'c', count=3)
+        self.assertEqual(self.writer.flush(), 2)
+        self.assertEqual(self.get_uuids(), [u'a', u'c'])
+        self.assertEqual(self.writer.buffer, [])
+        self.assertEqual(self.writer.stats.rejected, 1)
+        self.assertEqual(len(self.errors), 1)
+        self.assertIsInstance(self.errors[0], ValueError)
+        # nothing left to retry
+        self.assertEqual(self.writer.flush(), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+import unittest
+from decimal import Decimal
+
+from sqlalchemy import Column, select, event
+from sqlalchemy.ext.mutable import MutableDict
+from sqlalchemy.orm import Session
+
+from helpers import Node, new_session, build_tree
+from node.model import DictProperty, Edge, NodeMetaIndex, PREFETCHED_KEY, prefetch_related
+from node.util import JSONEncodedObj
+
+
+class Article(Node):
+    __mapper_args__ = {'polymorphic_identity': u'article'}
+    _meta = Column('meta', MutableDict.as_mutable(JSONEncodedObj))
+    _color = DictProperty('color', '_meta')
+
+    def __init__(self, *args, **kws):
+        super(Article, self).__init__(*args, **kws)
+        self._meta = {}
+
+
+class TaggedArticle(Article):
+    __mapper_args__ = {'polymorphic_identity': u'tagged_article'}
+    _tag = DictProperty('tag', '_meta', indexed=True)
+
+
+class PublicPropertiesTest(unittest.TestCase):
+
+    def test_descriptor_alias(self):
+        s = new_session()
+        article = Article()
+        article.color = u'red'
+        self.assertEqual(article._meta, {u'color': u'red'})
+        self.assertNotIn('color', article.__dict__)
+        s.add(article)
+        s.commit()
+        s.expire_all()
+        article = s.query(Article).one()
+        self.assertEqual(article.color, u'red')
+        self.assertEqual(article.meta, {u'color': u'red'})
+
+    def test_methods_not_aliased(self):
+        self.assertFalse(hasattr(Article, 'set_children'))
+        self.assertFalse(hasattr(Article, 'on_instrument_class'))
+
+
+class PrefetchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.session = new_session()
+        self.root, self.leaves = build_tree(self.session, 1, 4)
+        prefetch_related([self.root], 'children')
+        self.assertEqual(len(self.root.children), 4)
+
+    def test_flushed_edge(self):
+        self.session.add(Edge.create_edge(self.root, Node()))
+        self.session.flush()
+        self.assertEqual(len(self.root.children), 5)
+
+    def test_flushed_delete(self):
+        self.session.delete(self.root.children_relations[0])
+        self.session.flush()
+        self.assertEqual(len(self.root.children), 3)
+
+    def test_update_child_edges(self):
+        Edge.update_child_edges(self.root, self.leaves[:2])
+        self.assertEqual(len(self.root.children), 2)
+
+    def test_commit(self):
+        self.session.commit()
+        self.assertNotIn(PREFETCHED_KEY, self.root.__dict__)
+
+
+
+class EdgeMetaDataTest(unittest.TestCase):
+
+    def setUp(self):
+        self.session = new_session()
+        parent, child = Node(), Node()
+        self.session.add(Edge.create_edge(parent, child, metadata={u'k': 1, u'f': Decimal('1.10')}))
+        self.session.commit()
+        self.session.expunge_all()
+        self.edge = self.session.query(Edge).one()
+
+    def get_row_meta_data(self):
+        edges = Edge.__table__
+        return self.session.execute(select([edges.c.meta_data]).where(edges.c.id == self.edge.id)).scalar()
+
+    def test_decoded_on_read(self):
+        self.assertNotIn('_meta_data', self.edge.__dict__)
+        self.assertEqual(self.edge.meta_data, {u'k': 1, u'f': Decimal('1.10')})
+        self.assertIs(self.edge.meta_data, self.edge._meta_data)
+        self.assertFalse(self.session.is_modified(self.edge))
+
+    def test_private_and_core_reads(self):
+        self.assertEqual(dict(self.edge._meta_data), {u'k': 1, u'f': Decimal('1.10')})
+        self.assertEqual(self.get_row_meta_data(), {u'k': 1, u'f': Decimal('1.10')})
+
+    def test_copy_written_back(self):
+        self.edge._meta_data = dict(self.edge._meta_data, x=2)
+        self.session.commit()
+        self.assertEqual(self.get_row_meta_data(), {u'k': 1, u'f': Decimal('1.10'), u'x': 2})
+
+    def test_changed_in_place(self):
+        self.edge.meta_data[u'x'] = 2
+        self.session.commit()
+        self.assertEqual(self.get_row_meta_data(), {u'k': 1, u'f': Decimal('1.10'), u'x': 2})
+
+
+
+class NodeMetaIndexTest(unittest.TestCase):
+
+    def test_listening_once_indexed(self):
+        self.assertTrue(NodeMetaIndex._listening)
+        self.assertTrue(event.contains(Session, 'after_flush', NodeMetaIndex.after_flush))
+
+    def test_filter(self):
+        s = new_session()
+        red, blue = TaggedArticle(), TaggedArticle()
+        red.tag, blue.tag = u'red', u'blue'
+        s.add_all([red, blue, Article()])
+        s.commit()
+        found = s.query(Node).filter(TaggedArticle._tag.get_filter_clause(u'red')).all()
+        self.assertEqual([node.uuid for node in found], [red.uuid])
+
+
+if __name__ == '__main__':
+    unittest.main()
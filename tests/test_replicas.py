@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+import shutil
+import tempfile
+import unittest
+
+from sqlalchemy import select
+
+from helpers import Node
+from node import Base
+from node.db_util import DBUtil, EngineRegistry
+from node.model import Edge
+
+
+class LaggingReplicaTest(unittest.TestCase):
+    """The replica has the nodes but none of the edges of the primary, writes
+    depending on the current edges must read them from the primary."""
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        conf = {'db_url': 'sqlite:///{0}/'.format(self.path), 'db_name': 'primary.db', 'replicas': [{'db_name': 'replica.db'}]}
+        self.db = DBUtil(conf)
+        self.db.init_sessionmaker()
+        self.replica = EngineRegistry.get_engine(dict(conf, db_name='replica.db'))
+        for engine in (self.db.engine, self.replica):
+            Base.metadata.create_all(engine)
+
+        s = self.db.new_session()
+        p, a, b = Node(), Node(), Node()
+        s.add_all([p, a, b])
+        s.add(Edge.create_edge(p, b))
+        self.p, self.a, self.b = p.uuid, a.uuid, b.uuid
+        s.commit()
+        nodes = Node.__table__
+        rows = [dict(row) for row in self.db.engine.execute(select([nodes]))]
+        self.replica.execute(nodes.insert(), rows)
+        s.close()
+        self.session = self.db.new_session()
+
+    def tearDown(self):
+        self.session.close()
+        EngineRegistry.dispose_all()
+        shutil.rmtree(self.path)
+
+    def get_pairs(self):
+        edges = Edge.__table__
+        return sorted(tuple(row) for row in self.db.engine.execute(select([edges.c.left_uuid, edges.c.right_uuid])))
+
+    def test_reads_go_to_replica(self):
+        self.assertEqual(self.session.query(Edge).count(), 0)
+
+    def test_update_child_edges(self):
+        p = self.session.query(Node).get(self.p)
+        a = self.session.query(Node).get(self.a)
+        result = Edge.update_child_edges(p, [a])
+        self.session.commit()
+        self.assertEqual(result['removed'], [self.b])
+        self.assertEqual(self.get_pairs(), [(self.p, self.a)])
+
+    def test_cycle_check(self):
+        b = self.session.query(Node).get(self.b)
+        p = self.session.query(Node).get(self.p)
+        self.assertRaises(Exception, Edge.update_child_edges, b, [p])
+        self.assertRaises(Exception, Edge.create_edge, b, p)
+
+    def test_remove_all_edges(self):
+        p = self.session.query(Node).get(self.p)
+        self.session.add(Edge.create_edge(p, self.session.query(Node).get(self.a)))
+        self.session.commit()
+        Edge.remove_all_edges(p)
+        self.session.commit()
+        self.assertEqual(self.get_pairs(), [])
+
+
+if __name__ == '__main__':
+    unittest.main()